@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import queue
+import threading
+from threading import Thread
+from collections import OrderedDict
+
+from run_command import Utils
+from config import Prefs
+
+# Ends the payload a batch command receives on its standard input
+BATCH_DELIMITER = "GGH_BATCH_END"
+
+
+# Renders one shell command for a whole batch of distingueurs. Every distingueur
+# gives one line of the here-document fed to the command, lineTemplate with the
+# placeholder replaced (the bare distingueur if there is no lineTemplate).
+# The command is grouped so that a pipeline reads the payload with its first stage.
+def renderBatch(command, lineTemplate, placeholder, items):
+	if lineTemplate == None:
+		lines = [str(item) for item in items]
+	else:
+		lines = [lineTemplate.replace(placeholder, str(item)) for item in items]
+	return "{{ {}\n}} <<'{}'\n{}\n{}".format(command, BATCH_DELIMITER, "\n".join(lines), BATCH_DELIMITER)
+
+
+class ActionWorker(Thread):
+	def __init__(self, index, queueSize, timeout):
+		super(ActionWorker, self).__init__()
+		self.name = "Action worker {}".format(index)
+		self.daemon = True
+		self.q = queue.Queue(queueSize)
+		self._timeout = timeout
+		self.executed = 0
+		self.failed = 0
+		self.busy = False
+
+	def run(self):
+		while True:
+			action = self.q.get()
+			self.busy = True
+			try:
+				if Utils.execute_action(action, timeout=self._timeout) == False:
+					self.failed += 1
+			except Exception as e:
+				print("ERROR: Action [{}] failed ~ {}".format(action, e))
+				self.failed += 1
+			finally:
+				self.executed += 1
+				self.busy = False
+				self.q.task_done()
+
+
+# Bounded pool running ACTION and ANTIACTION commands off the detection threads.
+# Every target (distingueur) is always served by the same worker, so the
+# commands for one target run in the order they were submitted (ban before unban).
+# A full worker queue blocks the submitter, which bounds the backlog.
+class ActionExecutor(object):
+	_instance = None
+	_instanceLock = threading.Lock()
+
+	def __init__(self, workers = 4, queueSize = 10000, timeout = 60):
+		self._workers = [ActionWorker(i, queueSize, timeout) for i in range(workers)]
+		self._submitted = 0
+		self._next = 0
+		for worker in self._workers:
+			worker.start()
+
+	@staticmethod
+	def getInstance():
+		with ActionExecutor._instanceLock:
+			if ActionExecutor._instance is None:
+				_prefs = Prefs()
+				ActionExecutor._instance = ActionExecutor(
+					workers=max(1, int(_prefs.getGeneralPref('ACTION_WORKERS', 4))),
+					queueSize=int(_prefs.getGeneralPref('ACTION_QUEUE_SIZE', 10000)),
+					timeout=int(_prefs.getGeneralPref('ACTION_TIMEOUT', 60)))
+			return ActionExecutor._instance
+
+	# Index of the worker serving target, None spreads over the workers
+	def __workerIndex(self, target):
+		if target is None:
+			# no ordering to keep
+			index = self._next % len(self._workers)
+			self._next += 1
+			return index
+		return hash(target) % len(self._workers)
+
+	def submit(self, action, target = None):
+		if action == None:
+			return
+		self._workers[self.__workerIndex(target)].q.put(action)
+		self._submitted += 1
+
+	# One command per worker for the items it serves. Every item is a target: its
+	# batch is ordered with the single commands for it, e.g. a BATCH_ACTION ban
+	# always runs before the ANTIACTION unban of the same distingueur.
+	def submitBatch(self, command, lineTemplate, placeholder, items):
+		if command == None or items == []:
+			return
+		groups = OrderedDict()
+		for item in items:
+			groups.setdefault(self.__workerIndex(item), []).append(item)
+		for index, group in groups.items():
+			print("Executing batch of {} -> {}".format(len(group), command))
+			self._workers[index].q.put(renderBatch(command, lineTemplate, placeholder, group))
+			self._submitted += 1
+
+	def getQueueDepth(self):
+		return sum(worker.q.qsize() for worker in self._workers)
+
+	def getStats(self):
+		return {
+			'workers' : len(self._workers),
+			'submitted' : self._submitted,
+			'queued' : self.getQueueDepth(),
+			'running' : sum(1 for worker in self._workers if worker.busy),
+			'executed' : sum(worker.executed for worker in self._workers),
+			'failed' : sum(worker.failed for worker in self._workers),
+			'queue_depth_per_worker' : [worker.q.qsize() for worker in self._workers]
+		}
+
+	# Waits up to timeout seconds until the queued actions are executed
+	def drain(self, timeout):
+		deadline = time.time() + timeout
+		while self.getQueueDepth() > 0 or any(worker.busy for worker in self._workers):
+			if time.time() > deadline:
+				return False
+			time.sleep(0.1)
+		return True
+
+	@staticmethod
+	def drainPending(timeout):
+		if ActionExecutor._instance is None:
+			return True
+		return ActionExecutor._instance.drain(timeout)
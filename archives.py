@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import re
+import bz2
+import glob
+import gzip
+import lzma
+
+try:
+	import zstandard
+except ImportError:
+	# .zst archives are skipped without it
+	zstandard = None
+
+from linereader import READ_BLOCK
+
+# Suffixes logrotate gives to the previous log files: .1, .2.gz, -20200922, -20200922.xz
+ROTATED_SUFFIX_REGEX = re.compile(r"""^(\.\d+|-\d{8,10})?(\.gz|\.bz2|\.xz|\.zst)?$""")
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.xz', '.zst')
+
+
+def isArchive(path):
+	return path.endswith(COMPRESSED_SUFFIXES) or re.search(r"""(\.\d+|-\d{8,10})$""", path) is not None
+
+
+# Log files of a LOG_LOCATION which may be a glob pattern, without the archives
+def findLiveFiles(pattern):
+	if not glob.has_magic(pattern):
+		return [pattern]
+	return sorted(path for path in glob.glob(pattern) if os.path.isfile(path) and not isArchive(path))
+
+
+# Rotated siblings of livePath among the files of the glob pattern, oldest first.
+# A plain LOG_LOCATION has no archives.
+def findArchives(livePath, pattern):
+	if not glob.has_magic(pattern):
+		return []
+	archives = []
+	for path in glob.glob(pattern):
+		if path == livePath or not path.startswith(livePath) or not os.path.isfile(path):
+			continue
+		if ROTATED_SUFFIX_REGEX.match(path[len(livePath):]) is None:
+			continue
+		if path.endswith('.zst') and zstandard is None:
+			print("Skipping [{}], the zstandard package is missing: pip3 install zstandard".format(path))
+			continue
+		archives.append(path)
+	return sorted(archives, key=lambda path: (os.stat(path).st_mtime, -len(path)))
+
+
+# Binary stream of a (compressed) archive, decompressed block by block
+def openArchive(path):
+	if path.endswith('.gz'):
+		return gzip.open(path, "rb")
+	elif path.endswith('.bz2'):
+		return bz2.open(path, "rb")
+	elif path.endswith('.xz'):
+		return lzma.open(path, "rb")
+	elif path.endswith('.zst'):
+		return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_size=READ_BLOCK, closefd=True), READ_BLOCK)
+	return open(path, "rb", buffering=0)
+
+
+# "st_dev st_ino st_size" of an archive, a checkpoint of the same identity means it was scanned
+def archiveIdentity(path):
+	st = os.stat(path)
+	return "{} {} {}".format(st.st_dev, st.st_ino, st.st_size)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from linereader import LineReader
+
+# A range is never smaller than this, smaller files are not worth the processes
+MIN_RANGE = 4 * 1024 * 1024
+
+# Ranges per worker, so that a slow range does not leave the other workers idle
+RANGES_PER_WORKER = 4
+
+# How far back from the end of the file the last complete line is looked for
+TAIL_WINDOW = 1024 * 1024
+
+
+# End of the last complete line before end, the partial line being written
+# is left to the live scan
+def alignEnd(path, start, end):
+	with open(path, "rb") as fp:
+		pos = end
+		while pos > start:
+			size = min(TAIL_WINDOW, pos - start)
+			chunk = os.pread(fp.fileno(), size, pos - size)
+			newline = chunk.rfind(b"\n")
+			if newline >= 0:
+				return pos - size + newline + 1
+			pos -= size
+	return start
+
+
+# Splits [start, end) into byte ranges beginning at a line start
+def splitRanges(path, start, end, parts):
+	step = max((end - start) // max(parts, 1), MIN_RANGE)
+	bounds = [start]
+	with open(path, "rb") as fp:
+		pos = start + step
+		while pos < end:
+			fp.seek(pos)
+			fp.readline()
+			pos = fp.tell()
+			if pos >= end:
+				break
+			bounds.append(pos)
+			pos += step
+	bounds.append(end)
+	return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Worker: counts the distingueurs of every rule over the lines starting in [start, end).
+# specs holds (bytes pattern, flags, group index, required bytes literal) per rule,
+# combined is the bytes pattern of the prefilter (None if inactive). Returns one
+# dict {distingueur: hits} per rule.
+def scanRange(path, start, end, combined, specs):
+	rules = [(re.compile(pattern, flags), group, literal) for pattern, flags, group, literal in specs]
+	prefilter = re.compile(combined) if combined is not None else None
+	counts = [{} for spec in specs]
+
+	with open(path, "rb", buffering=0) as fp:
+		fp.seek(start)
+		reader = LineReader(fp)
+		buf = reader.getBuffer()
+		if prefilter is not None:
+			lines = reader.candidates(prefilter, limit=end - start, final=True)
+		else:
+			lines = reader.lines(limit=end - start, final=True)
+		for lineStart, lineEnd in lines:
+			for i, (regex, group, literal) in enumerate(rules):
+				if group is None or (literal is not None and buf.find(literal, lineStart, lineEnd) < 0):
+					continue
+				r1 = regex.search(buf, lineStart, lineEnd)
+				if r1 is None:
+					continue
+				element = r1.group(group)
+				if element is not None:
+					element = element.decode(errors="replace")
+					counts[i][element] = counts[i].get(element, 0) + 1
+	return counts
+
+
+# Processes of the pool are not forked from the threaded daemon
+def _getContext():
+	methods = multiprocessing.get_all_start_methods()
+	return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+# Scans [start, end) of path in a pool of workers and merges their partial
+# counters, one dict {distingueur: hits} per spec
+def backfill(path, start, end, combined, specs, workers):
+	ranges = splitRanges(path, start, end, workers * RANGES_PER_WORKER)
+	print("Backfilling [{}] bytes {}-{} in {} ranges with {} workers".format(path, start, end, len(ranges), workers))
+
+	merged = [{} for spec in specs]
+	with ProcessPoolExecutor(max_workers=min(workers, len(ranges)), mp_context=_getContext()) as pool:
+		futures = [pool.submit(scanRange, path, rangeStart, rangeEnd, combined, specs) for rangeStart, rangeEnd in ranges]
+		for future in futures:
+			for i, counts in enumerate(future.result()):
+				total = merged[i]
+				for element, hits in counts.items():
+					total[element] = total.get(element, 0) + hits
+	return merged
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import threading
+import sqlite3
+
+try:
+	from prettytable import PrettyTable
+except ImportError:
+	sys.stderr.write("Missing `prettytable` package: pip3 install prettytable\n")
+	sys.exit(1)
+
+from config import Prefs
+
+table_checkpoints = """
+				CREATE TABLE IF NOT EXISTS checkpoints (
+				name TEXT NOT NULL,
+				kind TEXT,
+				identity TEXT,
+				position TEXT,
+				"updatedAt" REAL,
+				PRIMARY KEY (name)
+				)
+				"""
+
+upsert_checkpoint = "INSERT OR REPLACE INTO checkpoints(name, kind, identity, position, updatedAt) VALUES(?, ?, ?, ?, ?)"
+
+# Kinds of checkpoints
+KIND_FILE = "file"
+KIND_JOURNALD = "journald"
+KIND_ARCHIVE = "archive"
+
+DATADIR = os.path.dirname(os.path.realpath(__file__)) + '/' + 'data/'
+CHECKPOINTSFILENAME = 'checkpoints.db'
+
+
+# Where every log file (offset) and every journald reader (cursor) stopped, in one
+# SQLite table. The positions are kept in memory and written together in one
+# transaction every CHECKPOINT_INTERVAL seconds, at every daemon cycle and at
+# shutdown, so a crash never leaves a half written checkpoint behind.
+class CheckpointStore(object):
+	_instance = None
+	_instanceLock = threading.Lock()
+
+	def __init__(self, path, interval = 5):
+		self._interval = interval
+		self._lock = threading.Lock()
+		# one flush at a time, an older snapshot must not be written after a newer one
+		self._flushLock = threading.Lock()
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute(table_checkpoints)
+		self._db.commit()
+
+		# name -> (kind, identity, position, updatedAt)
+		self._checkpoints = {}
+		for name, kind, identity, position, updatedAt in self._db.execute("SELECT name, kind, identity, position, updatedAt FROM checkpoints"):
+			self._checkpoints[name] = (kind, identity, position, updatedAt)
+		self._dirty = set()
+		self._lastFlush = time.time()
+
+	@staticmethod
+	def getInstance():
+		with CheckpointStore._instanceLock:
+			if CheckpointStore._instance is None:
+				CheckpointStore._instance = CheckpointStore(DATADIR + CHECKPOINTSFILENAME,
+					interval=int(Prefs().getGeneralPref('CHECKPOINT_INTERVAL', 5)))
+			return CheckpointStore._instance
+
+	# (identity, position) of name, None if there is no checkpoint
+	def get(self, name):
+		with self._lock:
+			checkpoint = self._checkpoints.get(name)
+		if checkpoint is None:
+			return None
+		return checkpoint[1], checkpoint[2]
+
+	def update(self, name, kind, identity, position):
+		with self._lock:
+			self._checkpoints[name] = (kind, identity, str(position), time.time())
+			self._dirty.add(name)
+			due = time.time() - self._lastFlush >= self._interval
+		if due:
+			self.flush()
+
+	def flush(self):
+		with self._flushLock:
+			with self._lock:
+				rows = [(name,) + self._checkpoints[name] for name in self._dirty]
+				self._dirty = set()
+				self._lastFlush = time.time()
+			if rows == []:
+				return
+			try:
+				with self._db:
+					self._db.executemany(upsert_checkpoint, rows)
+			except sqlite3.Error as e:
+				print("ERROR: Checkpoints could not be saved ~ {}".format(e))
+				with self._lock:
+					self._dirty.update(row[0] for row in rows)
+
+	@staticmethod
+	def flushPending():
+		if CheckpointStore._instance is not None:
+			CheckpointStore._instance.flush()
+
+	# Checkpoint of every log file and journald reader with how far behind it is:
+	# bytes not read yet (log files) and seconds since the last update
+	def getLag(self):
+		now = time.time()
+		with self._lock:
+			checkpoints = sorted(self._checkpoints.items())
+			dirty = set(self._dirty)
+		lag = []
+		for name, (kind, identity, position, updatedAt) in checkpoints:
+			behind = None
+			if kind == KIND_FILE:
+				try:
+					behind = max(os.stat(name).st_size - int(position), 0)
+				except (OSError, ValueError):
+					pass
+			lag.append({
+				'name' : name,
+				'kind' : kind,
+				'position' : position,
+				'bytes_behind' : behind,
+				'seconds_since_update' : round(now - updatedAt, 1) if updatedAt != None else None,
+				'saved' : name not in dirty
+			})
+		return lag
+
+	def getLagTable(self):
+		x = PrettyTable()
+		x.field_names = ["[Name]", "[Kind]", "[Position]", "[Bytes behind]", "[Updated (s ago)]", "[Saved]"]
+		for item in self.getLag():
+			x.add_row([item['name'], item['kind'], item['position'], item['bytes_behind'], item['seconds_since_update'], item['saved']])
+		return str(x)
+
+	def getLagJSON(self):
+		return json.dumps({'checkpoints' : self.getLag()})
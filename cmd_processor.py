@@ -7,8 +7,10 @@ import re
 import pickle
 import socket
 
-from run_command import Utils
+from action_executor import ActionExecutor
 from database import Database
+from config import ServicesManager
+from checkpoints import CheckpointStore
 #from rule_executor import DbWatcher
 import constants
 
@@ -38,6 +40,11 @@ class CommandProcessor(object):
 			"db events reset" : "Reset events table, all events with planned antiaction will be lost",
 			"db eventlog show [json]" : "Show detected events stored in database",
 			"db eventlog remove ID" : "Removes event with a corresponding ID from eventlog table",
+			"db pending" : "Show the number of event writes waiting to be flushed to the database",
+			"checkpoints show [json]" : "Show where every log file and journald reader stopped and how far behind it is",
+			"actions stats" : "Show queue depth and counters of the ACTION/ANTIACTION worker pool",
+			"prefilter stats" : "Show hit/miss counters of the literal prefilter of every service",
+			"daemon reload" : "Reload the configuration file, counters of unchanged rules are kept",
 			"daemon stop" : "Stop GGH daemon",
 			}}
 			return json.dumps(commandlist) + END_SELF
@@ -55,12 +62,35 @@ class CommandProcessor(object):
 			self.daemonInstance.stop()
 			return "Shutting daemon down ..." + END_SELF
 
+		if command == "daemon reload":
+			self.daemonInstance.reload()
+			return "Configuration reload has been scheduled." + END_SELF
+
 		if command == "db events check":
 			self.db.checkLifeOfEvents()
 			#self.dbWatcher.onThread(self.dbWatcher.checkEventsNow)
 			#self.dbWatcher.start()
 			return "Validity of all events in database has been checked." + END_SELF
 
+		if command == "prefilter stats":
+			stats = {}
+			for service in ServicesManager().getAllServices():
+				if service.getPrefilter() is not None and service.getEnabledRules() != []:
+					stats[service.getName()] = service.getPrefilter().getStats()
+			return json.dumps({'prefilter' : stats}) + END_SELF
+
+		if command == "db pending":
+			return "Pending database writes: {}".format(Database.getPendingCount()) + END_SELF
+
+		if command == "checkpoints show":
+			return CheckpointStore.getInstance().getLagTable() + END_SELF
+
+		if command == "checkpoints show json":
+			return CheckpointStore.getInstance().getLagJSON() + END_SELF
+
+		if command == "actions stats":
+			return json.dumps({'actions' : ActionExecutor.getInstance().getStats()}) + END_SELF
+
 		if command == "db eventlog show":
 			ret = self.db.getAllEventlog()
 			return ret + END_SELF
@@ -90,8 +120,12 @@ class CommandProcessor(object):
 			match = re.search('(?<=db events release )\d+$', command)
 			if match != None:
 				idx = match.group()
-				antiaction = self.db.getAntiactionByID(idx)
-				Utils.execute_action(antiaction)
+				event = self.db.getEventByID(idx)
+				if event == None:
+					return "Event ID not found." + END_SELF
+				if not self.db.submitAntiaction(*event):
+					# the host would stay banned with the event gone
+					return "Event with ID {} cannot be released, rule [{}] of service [{}] has no ANTIACTION.".format(idx, event[1], event[0]) + END_SELF
 				self.db.removeEventByID(idx)
 			else:
 				return "Event ID not found." + END_SELF
@@ -5,10 +5,24 @@ import os
 import re
 import time
 
+from prefilter import Prefilter
+from hosts_index import HostsIndex, loadRangeFile
+from counters import SlidingWindowCounter, ApproximateCounter
+
+# Marks a getGeneralPref call without a default value
+_NO_DEFAULT = object()
+
+# Window for counting the hits of a distingueur, when FINDTIME is not set
+DEFAULT_FINDTIME = 600
+
+# journald field the REGEX of a rule is applied to, when REGEX_FIELD is not set
+DEFAULT_REGEX_FIELD = "MESSAGE"
+
 class Prefs():
 	# Keep instance reference
 	_singletonInstance = None
 	_configFile = None
+	_hostsIndex = None
 
 	def __new__(cls, *args, **kwargs):
 		if not cls._singletonInstance:
@@ -29,6 +43,10 @@ class Prefs():
 	def getInstance():
 		return Prefs._singletonInstance
 
+	@staticmethod
+	def getConfigFile():
+		return Prefs._configFile
+
 	# The calculate_seconds function is taken from https://github.com/denyhosts/denyhosts/blob/master/DenyHosts/util.py
 	# In accordance with § 31 zákona č. 121/2000 Sb., autorský zákon
 	def calculate_seconds(self, timestr, zero_ok=False):
@@ -68,15 +86,18 @@ class Prefs():
 	def load_prefs(self, confFile):
 		PREFS_REGEX = re.compile(r"""(?P<name>.*?)\s*[:=]\s*(?P<value>.*)""")
 		SERVICE_REGEX = re.compile(r"""\[(?P<service>.*?)\]""")
-		TIME_REGEX = re.compile(r"""(?P<data>\d*[smhdwy])""")
+		# the whole value, paths such as misc/deny.list are not durations
+		TIME_REGEX = re.compile(r"""(?P<data>\d+[smhdwy])""")
 
 		RULE_REGEX = re.compile(r"""(?P<ruleid>\d+)_(?P<prefname>\D+)""")
 		LOGPREF_REGEX = re.compile(r"""(?P<prefname>LOG_LOCATION).*""")
 
-		try:
-			fp = open(confFile, "r")
+		# the services are parsed aside and replace the loaded ones at once,
+		# so that a reload does not show a half-read config to other threads
+		servicesManager = ServicesManager([])
 
-			servicesManager = ServicesManager()
+		# the old config stays if the file cannot be read
+		with open(confFile, "r") as fp:
 
 			for line in fp:
 				line = line.strip()
@@ -106,29 +127,29 @@ class Prefs():
 								service.setRetroactive(value)
 
 							#calculate seconds
-							t = TIME_REGEX.match(value)
+							t = TIME_REGEX.fullmatch(value)
 							if t is not None:
-								# convert time values to seconds
-								value = self.calculate_seconds(t.group('data'))
+								# convert time values to seconds, only FINDTIME may be 0
+								findtime = name == "FINDTIME" or name.endswith("_FINDTIME")
+								value = self.calculate_seconds(t.group('data'), zero_ok=findtime)
 								#print(value)
 
 							#print("{}, {}").format(name, value)
 
-							if not value:
+							# 0 (e.g. FINDTIME = 0s) is a value, only an empty one is not
+							if value == "":
 								value = None
 
 							(servicesManager.getServiceByName(serviceName)).addPref({name:value})
 
 				except Exception as e:
 					pass
-		except Exception as e:
-			pass
 
 		# refresh logfile location variable
 
 
 		# load Rules to their place
-		for service in ServicesManager().getAllServices():
+		for service in servicesManager.getAllServices():
 			for prefName in service.getPrefs().keys():
 				#print(prefName)
 				#if 
@@ -154,18 +175,82 @@ class Prefs():
 						rule.setRegex(val)
 					elif pref == "THRESHOLDCOUNT":
 						rule.setThresholdCount(val)
+					elif pref == "FINDTIME":
+						rule.setFindtime(val)
+					elif pref == "COUNTING":
+						rule.setCounting(val)
 					elif pref == "ACTION":
 						rule.setAction(val)
 					elif pref == "ANTIACTION":
 						rule.setAntiaction(val)
 					elif pref == "JAILTIME":
 						rule.setJailtime(val)
-
-	def getGeneralPref(self, prefName):
+					elif pref == "BATCH_ACTION":
+						rule.setBatchAction(val)
+					elif pref == "BATCH_ACTION_LINE":
+						rule.setBatchActionLine(val)
+					elif pref == "BATCH_ANTIACTION":
+						rule.setBatchAntiaction(val)
+					elif pref == "BATCH_ANTIACTION_LINE":
+						rule.setBatchAntiactionLine(val)
+					elif pref == "MATCH_FIELDS":
+						rule.setMatchFields(val)
+					elif pref == "REGEX_FIELD":
+						rule.setRegexField(val)
+
+		# a file without [general] is not a config, the daemon could not run on it
+		if servicesManager.getServiceByName("general") == None:
+			raise ValueError("No [general] section in {}".format(confFile))
+
+		# build the literal prefilters once the rules are complete
+		for service in servicesManager.getAllServices():
+			service.buildPrefilter()
+
+		Prefs._configFile = confFile
+		ServicesManager().setServices(servicesManager.getAllServices())
+
+		self.buildHostsIndex()
+
+	# default is returned for facultative prefs missing in [general],
+	# without a default a missing pref raises KeyError
+	def getGeneralPref(self, prefName, default=_NO_DEFAULT):
 		generalServ = ServicesManager().getServiceByName("general")
-		generalPrefs = generalServ.getPrefs()
+		generalPrefs = generalServ.getPrefs() if generalServ != None else {}
+		if default is not _NO_DEFAULT and generalPrefs.get(prefName) == None:
+			return default
 		return generalPrefs[prefName]
 
+	# HOSTS_ALLOW and HOSTS_DENY are parsed only once into an immutable prefix index
+	def buildHostsIndex(self):
+		generalServ = ServicesManager().getServiceByName("general")
+		generalPrefs = generalServ.getPrefs() if generalServ != None else {}
+		allow = (generalPrefs.get('HOSTS_ALLOW') or "").split(",")
+		deny = (generalPrefs.get('HOSTS_DENY') or "").split(",")
+		allowTables = self.__loadHostsFile(generalPrefs.get('HOSTS_ALLOW_FILE'))
+		denyTables = self.__loadHostsFile(generalPrefs.get('HOSTS_DENY_FILE'))
+		# the previous index is not closed, the journald watcher may still be checking
+		# an address with it. Its mapped caches are released once it is collected.
+		Prefs._hostsIndex = HostsIndex(allow=allow, deny=deny, allowTables=allowTables, denyTables=denyTables)
+		return Prefs._hostsIndex
+
+	# Large hosts lists are kept in a memory-mapped binary cache under data/
+	def __loadHostsFile(self, path):
+		if path == None or path == "":
+			return []
+		module_path = os.path.dirname(os.path.realpath(__file__))
+		if not path.startswith('/'):
+			path = os.path.join(module_path, path)
+		try:
+			return [loadRangeFile(path, os.path.join(module_path, 'data'))]
+		except (IOError, OSError) as e:
+			print("ERROR: Hosts list file could not be loaded ~ {}".format(e))
+			return []
+
+	def getHostsIndex(self):
+		if Prefs._hostsIndex is None:
+			return self.buildHostsIndex()
+		return Prefs._hostsIndex
+
 
 		#self.general.getPref()
 		#print servicesManager.getAllServicesNames()
@@ -174,6 +259,13 @@ class Prefs():
 		#print servicesManager.dumpPrefs()
 
 
+# strip first and last double quote of a pref value
+def stripQuotes(value):
+	if value != None and len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+		return value[1:-1]
+	return value
+
+
 class Rule(object):
 	def __init__(self, id, logfile = None, rulename = None, enabled = False, criteria_to_distinguish = None, regex = None, thresholdCount = None, action = None, antiaction = None, jailtime = None):
 		self._id = id
@@ -181,15 +273,35 @@ class Rule(object):
 		self._rulename = rulename
 		self._enabled = enabled
 		self._criteria_to_distinguish = criteria_to_distinguish
-		self._regex = regex
+		self._regex = None
+		self._compiledRegex = None
+		self._compiledBytesRegex = None
+		self._criteriaGroupIndex = None
 		self._thresholdCount = thresholdCount
 		self._action = action
 		self._antiaction = antiaction
 		self._jailtime = jailtime
 
+		# Batched commands get one line per distingueur on their standard input
+		self._batchAction = None
+		self._batchActionLine = None
+		self._batchAntiaction = None
+		self._batchAntiactionLine = None
+
 		self._nameOfBelongService = None
 
-		self._ip_x_occur_dict = dict()
+		# journald entries only: FIELD -> value every entry has to have,
+		# the field REGEX is applied to
+		self._matchFields = {}
+		self._regexField = None
+
+		# Hits per distingueur within FINDTIME, created with the first hit
+		self._findtime = None
+		self._counting = None
+		self._counter = None
+		self._counterSettings = None
+
+		self.setRegex(regex)
 
 	def getId(self):
 		return self._id
@@ -209,8 +321,90 @@ class Rule(object):
 	def getRegex(self):
 		return self._regex
 
+	# Pattern compiled once when REGEX is set, None if REGEX is missing or invalid
+	def getCompiledRegex(self):
+		return self._compiledRegex
+
+	# The same pattern for the raw bytes of log files. It is searched between the
+	# pos and endpos of a line in a larger buffer, MULTILINE makes ^ match at pos.
+	def getCompiledBytesRegex(self):
+		return self._compiledBytesRegex
+
+	# Index of the CRITERIA_TO_DISTINGUISH named group in the compiled pattern
+	def getCriteriaGroupIndex(self):
+		return self._criteriaGroupIndex
+
+	def getMatchFields(self):
+		return self._matchFields
+
+	def getRegexField(self):
+		return self._regexField if self._regexField != None else DEFAULT_REGEX_FIELD
+
+	# journald field holding the distingueur when CRITERIA_TO_DISTINGUISH
+	# is not a group of REGEX, None otherwise
+	def getCriteriaField(self):
+		if self._criteriaGroupIndex is not None or not self._criteria_to_distinguish:
+			return None
+		return self._criteria_to_distinguish
+
+	# Fields of a journald entry the rule looks at
+	def getJournalFields(self):
+		fields = set(self._matchFields)
+		fields.add(self.getRegexField())
+		if self.getCriteriaField() is not None:
+			fields.add(self.getCriteriaField())
+		return fields
+
+	# True if the journald entry (field -> text) has every value of MATCH_FIELDS
+	def matchesFields(self, fields):
+		for field, value in self._matchFields.items():
+			if fields.get(field) != value:
+				return False
+		return True
+
+	# Snapshot of the distingueurs counted within the window and their counts
 	def getIpXoccurDict(self):
-		return self._ip_x_occur_dict
+		return dict(self.getCounter().items())
+
+	def getCounter(self):
+		if self._counter is None:
+			self._counterSettings = self.__counterSettings()
+			_prefs = Prefs()
+			findtime = self._findtime if self._findtime != None else _prefs.getGeneralPref('FINDTIME', DEFAULT_FINDTIME)
+			if self.getCounting() == "approximate":
+				# fixed memory, whatever the number of distingueurs
+				self._counter = ApproximateCounter(int(findtime), self.getEffectiveThresholdCount(),
+					width=int(_prefs.getGeneralPref('SKETCH_WIDTH', 65536)),
+					depth=int(_prefs.getGeneralPref('SKETCH_DEPTH', 4)),
+					candidates=int(_prefs.getGeneralPref('SKETCH_CANDIDATES', 1024)))
+			else:
+				self._counter = SlidingWindowCounter(int(findtime), self.getEffectiveThresholdCount())
+		return self._counter
+
+	def getFindtime(self):
+		return self._findtime
+
+	def __counterSettings(self):
+		findtime = self._findtime if self._findtime != None else Prefs().getGeneralPref('FINDTIME', DEFAULT_FINDTIME)
+		return (int(findtime), self.getEffectiveThresholdCount(), self.getCounting())
+
+	# Takes over the counter of the same rule before a reload of the config,
+	# if the window, the threshold and the counting mode did not change
+	def adoptCounter(self, rule):
+		if rule._counter is not None and rule._counterSettings == self.__counterSettings():
+			self._counter = rule._counter
+			self._counterSettings = rule._counterSettings
+
+	# "exact" (default) or "approximate", from the rule or from [general]
+	def getCounting(self):
+		counting = self._counting if self._counting != None else Prefs().getGeneralPref('COUNTING', "exact")
+		return counting.strip('"').lower()
+
+	# THRESHOLDCOUNT of the rule, or the one from [general]
+	def getEffectiveThresholdCount(self):
+		if self._thresholdCount != None:
+			return int(self._thresholdCount)
+		return int(Prefs().getGeneralPref('THRESHOLDCOUNT'))
 
 	def getAction(self):
 		return self._action
@@ -224,6 +418,18 @@ class Rule(object):
 	def getJailtime(self):
 		return self._jailtime
 
+	def getBatchAction(self):
+		return self._batchAction
+
+	def getBatchActionLine(self):
+		return self._batchActionLine
+
+	def getBatchAntiaction(self):
+		return self._batchAntiaction
+
+	def getBatchAntiactionLine(self):
+		return self._batchAntiactionLine
+
 
 	def setNameOfBelongService(self, serviceName):
 		self._nameOfBelongService = serviceName
@@ -236,15 +442,49 @@ class Rule(object):
 
 	def setCriteriaToDistinguish(self, criteria):
 		self._criteria_to_distinguish = criteria
+		self.__resolveCriteriaGroup()
 
 	def setRegex(self, regex):
+		regex = stripQuotes(regex)
+		if regex == self._regex and self._compiledRegex is not None:
+			return
 		self._regex = regex
 
-	def setIpXoccurDict(self, dct):
-		self._ip_x_occur_dict = dct
+		self._compiledRegex = None
+		self._compiledBytesRegex = None
+		if regex != None:
+			try:
+				self._compiledRegex = re.compile(regex)
+			except re.error as e:
+				print("ERROR: Invalid REGEX of rule [{}] ~ {}".format(self._id, e))
+		if self._compiledRegex is not None:
+			try:
+				self._compiledBytesRegex = re.compile(regex.encode(), re.MULTILINE)
+			except re.error as e:
+				# e.g. \u escapes, such a rule is only applied to journald entries
+				print("ERROR: REGEX of rule [{}] cannot be applied to log files ~ {}".format(self._id, e))
+		self.__resolveCriteriaGroup()
+
+	def __resolveCriteriaGroup(self):
+		if self._compiledRegex is None:
+			self._criteriaGroupIndex = None
+			return
+		self._criteriaGroupIndex = self._compiledRegex.groupindex.get(self._criteria_to_distinguish)
+
+	# Counts weight hits of the distingueur, returns its count within the window
+	def hitDistingueur(self, distingueur, weight = 1):
+		return self.getCounter().hit(distingueur, weight=weight)
 
-	def updateIpXoccur(self, ipaddr, count):
-		self._ip_x_occur_dict.update({ipaddr: count})
+	def resetDistingueur(self, distingueur):
+		self.getCounter().reset(distingueur)
+
+	def setFindtime(self, findtime):
+		self._findtime = findtime
+		self._counter = None
+
+	def setCounting(self, counting):
+		self._counting = counting
+		self._counter = None
 
 	def setAction(self, action):
 		self._action = action
@@ -254,10 +494,38 @@ class Rule(object):
 
 	def setThresholdCount(self, thresholdCount):
 		self._thresholdCount = thresholdCount
+		self._counter = None
 
 	def setJailtime(self, jailtime):
 		self._jailtime = jailtime
 
+	def setBatchAction(self, batchAction):
+		self._batchAction = stripQuotes(batchAction)
+
+	def setBatchActionLine(self, batchActionLine):
+		self._batchActionLine = stripQuotes(batchActionLine)
+
+	def setBatchAntiaction(self, batchAntiaction):
+		self._batchAntiaction = stripQuotes(batchAntiaction)
+
+	def setBatchAntiactionLine(self, batchAntiactionLine):
+		self._batchAntiactionLine = stripQuotes(batchAntiactionLine)
+
+	# "FIELD=value, FIELD=value"
+	def setMatchFields(self, matchFields):
+		self._matchFields = {}
+		if matchFields == None:
+			return
+		for condition in stripQuotes(matchFields).split(','):
+			field, sep, value = condition.partition('=')
+			if sep == "" or field.strip() == "":
+				print("ERROR: Invalid MATCH_FIELDS condition [{}] of rule [{}]".format(condition.strip(), self._id))
+				continue
+			self._matchFields[field.strip().upper()] = value.strip()
+
+	def setRegexField(self, regexField):
+		self._regexField = regexField.strip().upper() if regexField != None else None
+
 
 class Service(object):
 	def __init__(self, name):
@@ -266,6 +534,7 @@ class Service(object):
 		self.rules = []
 		self._logfile = None
 		self._retroactive = False
+		self._prefilter = None
 
 	def addLogfile(self, logfile):
 		self._logfile = logfile
@@ -313,9 +582,19 @@ class Service(object):
 	def getRules(self):
 		return self.rules
 
+	def getEnabledRules(self):
+		return [rule for rule in self.rules if str(rule.getEnabled()).lower() == "true"]
+
+	def buildPrefilter(self):
+		self._prefilter = Prefilter(self.getEnabledRules())
+		return self._prefilter
+
+	def getPrefilter(self):
+		return self._prefilter
+
 	def getRuleByName(self, name):
 		for rule in self.rules:
-			if rule.getName() == name:
+			if rule.getRulename() == name:
 				return rule
 
 	def getRuleById(self, id):
@@ -335,6 +614,10 @@ class ServicesManager(object):
 		self.listOfServices = listOfServices
 		pass
 
+	# Replaces all the services, in place as the list is shared
+	def setServices(self, services):
+		self.listOfServices[:] = services
+
 	def addService(self, serviceObj):
 		self.listOfServices.append(serviceObj)
 		return serviceObj
@@ -347,6 +630,12 @@ class ServicesManager(object):
 	def getAllServices(self):
 		return self.listOfServices
 
+	# RULENAMEs are unique only within a service
+	def getRuleByName(self, serviceName, name):
+		serv = self.getServiceByName(serviceName)
+		if serv != None:
+			return serv.getRuleByName(name)
+
 	def getAllServicesNames(self):
 		res = []
 		for serv in self.listOfServices:
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+from array import array
+from collections import OrderedDict, deque
+
+
+# Counts the hits of every key (distingueur) within the last findtime seconds.
+# A key keeps at most cap timestamps, which is all it takes to tell whether
+# the threshold has been reached. Keys are ordered by their last hit, so the
+# idle ones are evicted from the front in amortized O(1) per hit.
+# findtime 0 (or None) disables the decay, the counts then never expire.
+class SlidingWindowCounter(object):
+	def __init__(self, findtime, cap):
+		self._findtime = findtime if findtime else None
+		self._cap = max(1, cap)
+		self._keys = OrderedDict()
+
+	# Records weight hits of key and returns its count within the window
+	def hit(self, key, now = None, weight = 1):
+		if now is None:
+			now = time.time()
+
+		hits = self._keys.get(key)
+		if hits is None:
+			hits = deque(maxlen=self._cap)
+			self._keys[key] = hits
+		else:
+			self._keys.move_to_end(key)
+		hits.extend([now] * min(weight, self._cap))
+
+		self.__evictIdle(now)
+		return self.__count(hits, now)
+
+	def count(self, key, now = None):
+		hits = self._keys.get(key)
+		if hits is None:
+			return 0
+		return self.__count(hits, time.time() if now is None else now)
+
+	def reset(self, key):
+		self._keys.pop(key, None)
+
+	# (key, count) of every key still within the window
+	def items(self, now = None):
+		if now is None:
+			now = time.time()
+		self.__evictIdle(now)
+		return [(key, self.__count(hits, now)) for key, hits in list(self._keys.items())]
+
+	# The key with the lowest count, None if there is no key
+	def weakest(self, now = None):
+		if now is None:
+			now = time.time()
+		weakestKey = None
+		weakestCount = None
+		for key, hits in self._keys.items():
+			cnt = self.__count(hits, now)
+			if weakestCount is None or cnt < weakestCount:
+				weakestKey, weakestCount = key, cnt
+		return weakestKey
+
+	def __contains__(self, key):
+		return key in self._keys
+
+	def __len__(self):
+		return len(self._keys)
+
+	def __count(self, hits, now):
+		if self._findtime is not None:
+			while len(hits) > 0 and hits[0] <= now - self._findtime:
+				hits.popleft()
+		return len(hits)
+
+	def __evictIdle(self, now):
+		if self._findtime is None:
+			return
+		while len(self._keys) > 0:
+			key, hits = next(iter(self._keys.items()))
+			if len(hits) > 0 and hits[-1] > now - self._findtime:
+				break
+			del self._keys[key]
+
+
+# Count-Min Sketch of fixed size (width x depth 32 bit cells) for the hits
+# of all keys, with exact SlidingWindowCounter entries only for the candidates
+# whose estimate got near the threshold (half of it). The sketch only selects
+# the candidates: a candidate counts its own hits from its promotion on, so the
+# overestimation due to collisions never makes a key reach the threshold.
+# The candidate set is bounded, a new candidate pushes out the weakest one.
+# Updates are conservative (only the cells below the new estimate are raised),
+# which keeps the overestimation due to collisions low.
+# The sketch decays by epochs of findtime: the estimate is the sum of the
+# current and the previous epoch, an older epoch is dropped as a whole.
+class ApproximateCounter(object):
+	def __init__(self, findtime, threshold, width = 65536, depth = 4, candidates = 1024):
+		self._findtime = findtime if findtime else None
+		self._threshold = max(1, threshold)
+		self._promoteAt = max(1, self._threshold // 2)
+		self._width = max(1, width)
+		self._depth = max(1, depth)
+		self._maxCandidates = max(1, candidates)
+
+		self._current = self.__newSketch()
+		self._previous = self.__newSketch()
+		self._epochStart = None
+		self._candidates = SlidingWindowCounter(findtime, self._threshold)
+
+	def __newSketch(self):
+		return array('I', bytes(4 * self._width * self._depth))
+
+	# Cell of every row for key (double hashing)
+	def __cells(self, key):
+		h = hash(key)
+		h1 = h & 0xffffffff
+		h2 = ((h >> 32) & 0xffffffff) | 1
+		return [row * self._width + (h1 + row * h2) % self._width for row in range(self._depth)]
+
+	def __rotate(self, now):
+		if self._findtime is None:
+			return
+		if self._epochStart is None:
+			self._epochStart = now
+			return
+		elapsed = now - self._epochStart
+		if elapsed < self._findtime:
+			return
+		if elapsed < 2 * self._findtime:
+			self._previous = self._current
+		else:
+			self._previous = self.__newSketch()
+		self._current = self.__newSketch()
+		self._epochStart = now
+
+	def __estimate(self, cells):
+		return min(self._current[cell] + self._previous[cell] for cell in cells)
+
+	# Records weight hits of key and returns its (estimated) count within the window
+	def hit(self, key, now = None, weight = 1):
+		if now is None:
+			now = time.time()
+		self.__rotate(now)
+
+		cells = self.__cells(key)
+		estimate = self.__estimate(cells) + weight
+		for cell in cells:
+			if self._current[cell] + self._previous[cell] < estimate:
+				self._current[cell] = estimate - self._previous[cell]
+		if key in self._candidates:
+			return self._candidates.hit(key, now, weight=weight)
+
+		if estimate < self._promoteAt:
+			return estimate
+
+		# near the threshold, count exactly from now on, starting with this hit
+		if len(self._candidates) >= self._maxCandidates:
+			self._candidates.reset(self._candidates.weakest(now))
+		return self._candidates.hit(key, now, weight=weight)
+
+	def count(self, key, now = None):
+		if key in self._candidates:
+			return self._candidates.count(key, now)
+		return self.__estimate(self.__cells(key))
+
+	# Forgets the exact count of the key. The cells of the sketch are shared with
+	# other keys, they are left to the epoch rotation.
+	def reset(self, key):
+		self._candidates.reset(key)
+
+	# Only the candidates are listed, all other keys are below the threshold
+	def items(self, now = None):
+		return self._candidates.items(now)
+
+	def getMemoryBudget(self):
+		return 2 * 4 * self._width * self._depth
+
+	def __len__(self):
+		return len(self._candidates)
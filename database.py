@@ -3,8 +3,11 @@
 
 import time
 import sys
+import heapq
 import json
 import os
+import threading
+from threading import Thread
 from collections import OrderedDict
 import sqlite3
 
@@ -14,7 +17,8 @@ except ImportError:
     sys.stderr.write("Missing `prettytable` package: pip3 install prettytable\n")
     sys.exit(1)
 
-from run_command import Utils
+from config import Prefs, ServicesManager
+from action_executor import ActionExecutor
 
 table_eventlog = """
 				CREATE TABLE IF NOT EXISTS eventlog (
@@ -36,42 +40,211 @@ table_events = """
 				"timeOfEvent" TEXT,
 				"eventExp" INTEGER,
 				antiaction TEXT,
+				"expiresAt" INTEGER,
 				PRIMARY KEY (id)
 				)
 				"""
 
+index_events = """
+				CREATE INDEX IF NOT EXISTS events_rule_distingueur
+				ON events ("comesFromRule", distingueur)
+				"""
+
+index_events_expiration = """
+				CREATE INDEX IF NOT EXISTS events_expires
+				ON events ("expiresAt")
+				"""
+
+insert_eventlog = "INSERT INTO eventlog(belongService, comesFromRule, distingueur, timeOfEvent) VALUES(?, ?, ?, ?)"
+insert_events = "INSERT INTO events(belongService, comesFromRule, distingueur, timeOfEvent, eventExp, antiaction, expiresAt) VALUES(?, ?, ?, ?, ?, ?, ?)"
+
+# Maximum number of expired events released in one transaction
+RELEASE_BATCH = 500
+
+DATADIR = os.path.dirname(os.path.realpath(__file__)) + '/' + 'data/'
+DBFILENAME = 'database.db'
+
+# Opens a connection to the database file and applies the DB_SYNCHRONOUS pref
+def connect():
+	try:
+		db = sqlite3.connect('{}{}'.format(DATADIR, DBFILENAME), check_same_thread=False)
+	except sqlite3.OperationalError as e:
+		print("ERROR: Database connection failed ~ {}".format(e))
+		sys.exit(1)
+	synchronous = Prefs().getGeneralPref('DB_SYNCHRONOUS', None)
+	if synchronous != None:
+		db.execute("PRAGMA synchronous = {}".format(synchronous.upper()))
+	return db
+
+
+# Write-behind queue shared by all Database instances.
+# Inserts into eventlog and events are queued and written with executemany in a
+# single transaction once DB_BATCH_SIZE rows are pending or DB_BATCH_INTERVAL
+# seconds have passed since the oldest pending row.
+class WriteBehind(Thread):
+	def __init__(self, batchSize = 100, flushInterval = 2):
+		super(WriteBehind, self).__init__()
+		self.name = "DB Writer"
+		self.daemon = True
+		self._batchSize = batchSize
+		self._flushInterval = flushInterval
+		self._cond = threading.Condition()
+		self._flushLock = threading.Lock()
+		self._pending = {'eventlog' : [], 'events' : []}
+		self._pendingCount = 0
+		self._oldest = None
+
+		self._db = connect()
+		journalMode = Prefs().getGeneralPref('DB_JOURNAL_MODE', None)
+		if journalMode != None:
+			mode = self._db.execute("PRAGMA journal_mode = {}".format(journalMode.upper())).fetchone()
+			print("Database journal mode -> {}".format(mode[0]))
+
+	def enqueue(self, table, row):
+		with self._cond:
+			self._pending[table].append(row)
+			self._pendingCount += 1
+			if self._oldest is None:
+				# first pending row, the writer has to start its interval timer
+				self._oldest = time.time()
+				self._cond.notify()
+			elif self._pendingCount >= self._batchSize:
+				self._cond.notify()
+
+	def getPendingCount(self):
+		return self._pendingCount
+
+	# Returns the number of rows written, None if the write failed
+	def flush(self):
+		with self._flushLock:
+			with self._cond:
+				pending = self._pending
+				count = self._pendingCount
+				self._pending = {'eventlog' : [], 'events' : []}
+				self._pendingCount = 0
+				self._oldest = None
+			if count == 0:
+				return 0
+			try:
+				with self._db:
+					self._db.executemany(insert_eventlog, pending['eventlog'])
+					self._db.executemany(insert_events, pending['events'])
+			except sqlite3.Error as e:
+				print("ERROR: Flushing {} pending writes failed, they are kept for the next flush ~ {}".format(count, e))
+				with self._cond:
+					# ahead of the rows queued meanwhile
+					for table in pending:
+						self._pending[table][:0] = pending[table]
+					self._pendingCount += count
+					self._oldest = time.time()
+				return None
+			return count
+
+	def run(self):
+		while True:
+			with self._cond:
+				if self._oldest is None:
+					timeout = None
+				else:
+					timeout = self._oldest + self._flushInterval - time.time()
+				if self._pendingCount < self._batchSize and (timeout is None or timeout > 0):
+					self._cond.wait(timeout)
+				due = self._pendingCount >= self._batchSize or \
+					(self._oldest is not None and self._oldest + self._flushInterval <= time.time())
+			if due and self.flush() is None:
+				# a full queue would be retried at once
+				time.sleep(self._flushInterval)
+
+
 class Database(object):
+	# The write-behind queue is created with the first queued write
+	_writer = None
+	_writerLock = threading.Lock()
+	# (comesFromRule, distingueur) pairs currently stored in events,
+	# loaded with the first lookup and kept in sync on insert and release
+	_jailed = None
+	_jailedLock = threading.Lock()
+	# Min-heap of the expiresAt epochs of stored events, the DbWatcher
+	# sleeps until its head. _expiryListener is woken up on a new head.
+	_expiries = None
+	_expiryLock = threading.Lock()
+	_expiryListener = None
+	_migrated = False
+
 	def __init__(self):
-		self._datadir = os.path.dirname(os.path.realpath(__file__)) + '/' + 'data/'
-		try:
-			self._db = sqlite3.connect('{}{}'.format(self._datadir, 'database.db'), check_same_thread=False)
-		except sqlite3.OperationalError as e:
-			print("ERROR: Database connection failed ~ {}".format(e))
-			sys.exit(1)
-			pass
+		self._datadir = DATADIR
+		self._db = connect()
 		self.cur = self._db.cursor()
 		self.cur.execute(table_eventlog)
 		self.cur.execute(table_events)
 
 		self.eventlog = "eventlog"
 		self.events = "events"
+
+		if not Database._migrated:
+			self.__migrateExpiration()
+			Database._migrated = True
+		self.cur.execute(index_events)
+		self.cur.execute(index_events_expiration)
 		pass
 
+	# Databases created before expiresAt existed get the column, computed once
+	# from the asctime() string and eventExp
+	def __migrateExpiration(self):
+		columns = [row[1] for row in self.cur.execute("PRAGMA table_info({})".format(self.events))]
+		if "expiresAt" in columns:
+			return
+		print("Adding expiresAt column to the {} table".format(self.events))
+		self.cur.execute("ALTER TABLE {} ADD COLUMN expiresAt INTEGER".format(self.events))
+		rows = self.cur.execute("SELECT id, timeOfEvent, eventExp FROM {}".format(self.events)).fetchall()
+		updates = []
+		for row in rows:
+			try:
+				updates.append((int(time.mktime(time.strptime(row[1]))) + int(row[2]), row[0]))
+			except (ValueError, TypeError):
+				# unparsable rows are released with the next check
+				updates.append((0, row[0]))
+		with self._db:
+			self._db.executemany("UPDATE {} SET expiresAt = ? WHERE id = ?".format(self.events), updates)
+
+	@staticmethod
+	def getWriter():
+		with Database._writerLock:
+			if Database._writer is None:
+				_prefs = Prefs()
+				Database._writer = WriteBehind(
+					batchSize=int(_prefs.getGeneralPref('DB_BATCH_SIZE', 100)),
+					flushInterval=int(_prefs.getGeneralPref('DB_BATCH_INTERVAL', 2)))
+				Database._writer.start()
+			return Database._writer
+
+	# Writes everything still waiting in the write-behind queue, e.g. on shutdown
+	@staticmethod
+	def flushPending():
+		if Database._writer is None:
+			return 0
+		return Database._writer.flush()
+
+	@staticmethod
+	def getPendingCount():
+		if Database._writer is None:
+			return 0
+		return Database._writer.getPendingCount()
+
 	def close(self):
 		self._db.close()
 
 	# Methods for eventlog table
 	# Time info is saved in time.asctime() format
 	def addEventlog(self, belongService, comesFromRule, distingueur, timeOfEvent):
-		self.cur.execute("INSERT INTO {}(belongService, comesFromRule, distingueur, timeOfEvent) VALUES(?, ?, ?, ?)"
-			.format(self.eventlog),(belongService, comesFromRule, distingueur, timeOfEvent))
-		self._db.commit()
+		Database.getWriter().enqueue(self.eventlog, (belongService, comesFromRule, distingueur, timeOfEvent))
 
 	def removeEventlogByID(self, id):
-		res = self.cur.execute("DELETE FROM {} WHERE id LIKE (?)".format(self.eventlog), id)
+		res = self.cur.execute("DELETE FROM {} WHERE id = ?".format(self.eventlog), (id,))
 		self._db.commit()
 
 	def getAllEventlog(self):
+		Database.flushPending()
 		result = self.cur.execute('SELECT * FROM {}'.format(self.eventlog))
 		# Use PrettyTable library for a neat table format
 		x = PrettyTable()
@@ -81,11 +254,13 @@ class Database(object):
 		return str(x)
 
 	def getAllEventlogJSON(self):
+		Database.flushPending()
 		result = self.cur.execute('SELECT * FROM {}'.format(self.eventlog))
 		items = [dict(zip([key[0] for key in self.cur.description], row)) for row in result]
 		return json.dumps({'eventlog' : items})
 
 	def resetEventlog(self):
+		Database.flushPending()
 		res = self.cur.execute("DELETE FROM {}".format(self.eventlog))
 		self._db.commit()
 		return res
@@ -93,15 +268,57 @@ class Database(object):
 	# Methods for events table
 	# Time info is saved in time.asctime() format
 	def addEvent(self, belongService, comesFromRule, distingueur, timeOfEvent, eventExp, antiaction):
-		self.cur.execute("INSERT INTO {}(belongService, comesFromRule, distingueur, timeOfEvent, eventExp, antiaction) VALUES(?, ?, ?, ?, ?, ?)"
-			.format(self.events),(belongService, comesFromRule, distingueur, timeOfEvent, eventExp, antiaction))
-		self._db.commit()
+		expiresAt = int(time.time()) + int(eventExp)
+		with Database._jailedLock:
+			self.__getJailed().add((comesFromRule, distingueur))
+			Database.getWriter().enqueue(self.events, (belongService, comesFromRule, distingueur, timeOfEvent, eventExp, antiaction, expiresAt))
+		self.__pushExpiry(expiresAt)
+
+	# Callers hold _jailedLock
+	def __getJailed(self):
+		if Database._jailed is None:
+			Database.flushPending()
+			result = self.cur.execute('SELECT comesFromRule, distingueur FROM {}'.format(self.events))
+			Database._jailed = set((row[0], row[1]) for row in result)
+		return Database._jailed
+
+	def __getExpiries(self):
+		with Database._expiryLock:
+			if Database._expiries is not None:
+				return Database._expiries
+		result = self.cur.execute('SELECT expiresAt FROM {} WHERE expiresAt IS NOT NULL'.format(self.events))
+		expiries = [row[0] for row in result]
+		heapq.heapify(expiries)
+		with Database._expiryLock:
+			if Database._expiries is None:
+				Database._expiries = expiries
+			return Database._expiries
+
+	def __pushExpiry(self, expiresAt):
+		expiries = self.__getExpiries()
+		with Database._expiryLock:
+			heapq.heappush(expiries, expiresAt)
+			newHead = expiries[0] == expiresAt
+		if newHead and Database._expiryListener != None:
+			Database._expiryListener()
+
+	# Callable run whenever a new event expires before all the stored ones
+	@staticmethod
+	def setExpiryListener(listener):
+		Database._expiryListener = listener
+
+	# Epoch of the next expiration, None if there is no event
+	def getNextExpiry(self):
+		expiries = self.__getExpiries()
+		with Database._expiryLock:
+			return expiries[0] if expiries != [] else None
 
 	def getEventsByService(self, belongService):
 		events = self.cur.execute("SELECT * FROM {} WHERE belongService LIKE ?".format(events), (belongService))
 		return events
 
 	def getAllEvents(self):
+		Database.flushPending()
 		result = self.cur.execute('SELECT * FROM {}'.format(self.events))
 		# Use PrettyTable library for a neat table format
 		x = PrettyTable()
@@ -111,47 +328,108 @@ class Database(object):
 		return str(x)
 
 	def getAllEventsJSON(self):
+		Database.flushPending()
 		result = self.cur.execute('SELECT * FROM {}'.format(self.events))
 		items = [dict(zip([key[0] for key in self.cur.description], row)) for row in result]
 		return json.dumps({'events' : items})
 			
 	def removeEventByID(self, id):
-		res = self.cur.execute("DELETE FROM {} WHERE id LIKE ?".format(self.events), (id,))
-		self._db.commit()
+		with Database._jailedLock:
+			Database.flushPending()
+			jailed = self.__getJailed()
+			row = self.cur.execute("SELECT comesFromRule, distingueur FROM {} WHERE id = ?".format(self.events), (id,)).fetchone()
+			self.cur.execute("DELETE FROM {} WHERE id = ?".format(self.events), (id,))
+			self._db.commit()
+			if row != None and not self.isDistingueurStored(row[1], row[0]):
+				jailed.discard((row[0], row[1]))
+
+	# (belongService, comesFromRule, distingueur, antiaction) of the event, None if there is none
+	def getEventByID(self, id):
+		Database.flushPending()
+		return self.cur.execute("SELECT belongService, comesFromRule, distingueur, antiaction FROM {} WHERE id = ?".format(self.events), (id,)).fetchone()
+
+	# Releases one event: the BATCH_ANTIACTION of its rule for its distingueur alone,
+	# or its stored ANTIACTION. False if neither is there, e.g. the rule was removed
+	# from the config and only had a BATCH_ANTIACTION.
+	def submitAntiaction(self, belongService, comesFromRule, distingueur, antiaction):
+		rule = ServicesManager().getRuleByName(belongService, comesFromRule)
+		if rule != None and rule.getBatchAntiaction() != None:
+			ActionExecutor.getInstance().submitBatch(rule.getBatchAntiaction(), rule.getBatchAntiactionLine(),
+				rule.getCriteriaToDistinguish(), [distingueur])
+		elif antiaction != None:
+			ActionExecutor.getInstance().submit(antiaction, target=distingueur)
+		else:
+			return False
+		return True
 
 	def getAntiactionByID(self, id):
-		result = self.cur.execute("SELECT antiaction FROM events WHERE id LIKE {}".format(id))
+		result = self.cur.execute("SELECT antiaction FROM events WHERE id = ?", (id,))
 		for row in result:
 			# return first match, we expect that ID is unique
 			return row[0]
 
+	# Exact match on the (comesFromRule, distingueur) index
+	def isDistingueurStored(self, distingueur, rulename):
+		result = self.cur.execute("SELECT 1 FROM {} WHERE comesFromRule = ? AND distingueur = ? LIMIT 1".format(self.events),
+			(rulename, distingueur))
+		return result.fetchone() != None
+
+	# O(1) lookup in the in-memory set of jailed (rule, distingueur) pairs
 	def checkDistingueurDetectedForRule(self, distingueur, rulename):
-		result = self.cur.execute("SELECT id, comesFromRule, distingueur FROM events WHERE distingueur LIKE '{}' AND comesFromRule LIKE '{}'".format(distingueur, rulename))
-		ruledict = {}
-		for row in result:
-			ruledict.update({row[1]:distingueur})
-			for key,val in ruledict.items():
-				print("{} -> {}".format(key, val))
-				if row[1] == key and distingueur == val:
-					return True
-			print(row)
-		print(ruledict)
-		return False
+		with Database._jailedLock:
+			return (rulename, distingueur) in self.__getJailed()
 
 	def resetEvents(self):
-		res = self.cur.execute("DELETE FROM {}".format(self.events))
-		self._db.commit()
+		with Database._jailedLock:
+			Database.flushPending()
+			res = self.cur.execute("DELETE FROM {}".format(self.events))
+			self._db.commit()
+			Database._jailed = set()
 		return res
 
 
-	# Go through all of the events and check whether they should be deleted already based on eventExp
+	# Release the events whose expiration has passed. Only due rows are read
+	# through the expiresAt index, antiactions run and the rows are deleted in
+	# batches of RELEASE_BATCH in one transaction each.
 	def checkLifeOfEvents(self):
-		result = self.cur.execute('SELECT timeOfEvent,eventExp,id,antiaction FROM {}'.format(self.events))
-		for row in result:
-			eventTime = int(time.mktime(time.strptime(row[0])))
-			if eventTime+row[1] <= int(time.time()):
+		now = int(time.time())
+		released = 0
+		while True:
+			with Database._jailedLock:
+				Database.flushPending()
+				rows = self.cur.execute("SELECT id, comesFromRule, distingueur, antiaction, belongService FROM {} WHERE expiresAt <= ? ORDER BY expiresAt LIMIT ?"
+					.format(self.events), (now, RELEASE_BATCH)).fetchall()
+			if rows == []:
+				break
+
+			# rules with BATCH_ANTIACTION release all their due distingueurs with one command
+			batches = OrderedDict()
+			for row in rows:
 				# execute antiaction and delete the entry
-				print("Event with ID {} has expired and will be released.".format(row[2]))
-				Utils.execute_action(row[3])
-				self.removeEventByID(row[2])
-				self._db.commit()
+				print("Event with ID {} has expired and will be released.".format(row[0]))
+				rule = ServicesManager().getRuleByName(row[4], row[1])
+				if rule != None and rule.getBatchAntiaction() != None:
+					batches.setdefault(rule, []).append(row[2])
+				elif row[3] != None:
+					ActionExecutor.getInstance().submit(row[3], target=row[2])
+			for rule, distingueurs in batches.items():
+				ActionExecutor.getInstance().submitBatch(rule.getBatchAntiaction(), rule.getBatchAntiactionLine(),
+					rule.getCriteriaToDistinguish(), distingueurs)
+
+			with Database._jailedLock:
+				jailed = self.__getJailed()
+				with self._db:
+					self._db.executemany("DELETE FROM {} WHERE id = ?".format(self.events), [(row[0],) for row in rows])
+				for row in rows:
+					if not self.isDistingueurStored(row[2], row[1]):
+						jailed.discard((row[1], row[2]))
+			released += len(rows)
+			if len(rows) < RELEASE_BATCH:
+				break
+
+		# drop the heap entries that are due, including those of manually released events
+		expiries = self.__getExpiries()
+		with Database._expiryLock:
+			while expiries != [] and expiries[0] <= now:
+				heapq.heappop(expiries)
+		return released
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+
+
+# A call scheduled on the EventLoop, cancel() drops it
+class Call(object):
+	def __init__(self, when, function, args, kwargs):
+		self.when = when
+		self.function = function
+		self.args = args
+		self.kwargs = kwargs
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+
+# The single scheduler of the daemon. Timed calls are kept in a heap and run one
+# after another by the thread in run(), which sleeps until the next one is due.
+# A call scheduled from another thread before the next one wakes it up.
+# Nothing polls and no thread is created per timer.
+class EventLoop(object):
+	_instance = None
+	_instanceLock = threading.Lock()
+
+	def __init__(self):
+		self._cond = threading.Condition()
+		# (when, sequence, Call), the sequence keeps the calls of the same time in order
+		self._calls = []
+		self._sequence = itertools.count()
+
+	@staticmethod
+	def getInstance():
+		with EventLoop._instanceLock:
+			if EventLoop._instance is None:
+				EventLoop._instance = EventLoop()
+			return EventLoop._instance
+
+	# Runs function(*args, **kwargs) at the epoch when
+	def callAt(self, when, function, *args, **kwargs):
+		call = Call(when, function, args, kwargs)
+		with self._cond:
+			heapq.heappush(self._calls, (when, next(self._sequence), call))
+			if self._calls[0][2] is call:
+				self._cond.notify()
+		return call
+
+	def callLater(self, delay, function, *args, **kwargs):
+		return self.callAt(time.time() + delay, function, *args, **kwargs)
+
+	# Before any timed call, in the order of the callSoon() calls
+	def callSoon(self, function, *args, **kwargs):
+		return self.callAt(0, function, *args, **kwargs)
+
+	def run(self):
+		while True:
+			call = self.__next()
+			try:
+				call.function(*call.args, **call.kwargs)
+			except Exception as e:
+				print("ERROR: Scheduled call {} failed ~ {}".format(getattr(call.function, '__name__', call.function), e))
+
+	# Waits for the next due call
+	def __next(self):
+		with self._cond:
+			while True:
+				while self._calls != [] and self._calls[0][2].cancelled:
+					heapq.heappop(self._calls)
+				if self._calls == []:
+					self._cond.wait()
+					continue
+				timeout = self._calls[0][0] - time.time()
+				if timeout <= 0:
+					return heapq.heappop(self._calls)[2]
+				self._cond.wait(timeout)
+
+
+# Commands and events of one component, run in the order they were posted by the
+# EventLoop thread. post() may be called from any thread.
+class Mailbox(object):
+	def __init__(self, name, loop = None):
+		self.name = name
+		self._loop = loop if loop is not None else EventLoop.getInstance()
+		self._messages = deque()
+		self._lock = threading.Lock()
+		self._scheduled = False
+
+	def post(self, function, *args, **kwargs):
+		with self._lock:
+			self._messages.append((function, args, kwargs))
+			if self._scheduled:
+				return
+			self._scheduled = True
+		self._loop.callSoon(self.__deliver)
+
+	def __deliver(self):
+		while True:
+			with self._lock:
+				if not self._messages:
+					self._scheduled = False
+					return
+				function, args, kwargs = self._messages.popleft()
+			try:
+				function(*args, **kwargs)
+			except Exception as e:
+				print("ERROR: [{}] {} failed ~ {}".format(self.name, getattr(function, '__name__', function), e))
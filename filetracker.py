@@ -1,130 +1,236 @@
 import os
+import glob
+import hashlib
 import logging
 import ntpath
 
+from checkpoints import CheckpointStore, KIND_FILE
+
 # This code comes partly / with minor mods from https://github.com/denyhosts/denyhosts/blob/master/DenyHosts/filetracker.py
 # In accordance with § 31 odst. 1 písm. a) zákona č. 121/2000 Sb., autorský zákon
 
 debug = logging.getLogger("filetracker").debug
 
+# Offset files of the previous versions, read only when there is no checkpoint yet
 OFFSET_APPEND = "._offset"
 
+# Number of bytes at the beginning of the log file hashed into its fingerprint
+FINGERPRINT_SIZE = 256
+
+# Where logrotate puts the previous log file (not compressed yet)
+ROTATED_PATTERNS = ["{}.1", "{}.0", "{}-[0-9]*[0-9]"]
+
+
+# Keeps the log file open between the scans and remembers how far it was read.
+# The file is identified by (st_dev, st_ino) and a fingerprint of its first bytes:
+#  - the path pointing to another inode means the file was rotated away, the rest of
+#    the old file is drained through the handle still open (or from its .1 sibling
+#    when the daemon was not running) before the new file is read from the beginning
+#  - the same inode being shorter than the offset, or its first bytes not matching
+#    the fingerprint any more, means copytruncate. The fingerprint of the open file is
+#    compared only when its mtime or ctime went backwards, not on every scan.
+#  - a fingerprint mismatch means another file got the same inode
+# The offset and the identity are kept in the CheckpointStore.
 class FileTracker(object):
     def __init__(self, logfile, retroactive = True):
         self.work_dir = os.path.dirname(os.path.realpath(__file__)) + '/data'
         #print(self.work_dir)
         self.logfile = logfile
         self.retroactive = retroactive
+        if logfile.startswith('/'):
+            self.path = logfile
+        else:
+            self.path = os.path.join(self.work_dir + "/..", logfile)
+        # name of the checkpoint
+        self.name = os.path.normpath(os.path.abspath(self.path))
+        self.store = CheckpointStore.getInstance()
 
         self.offset_file = ''.join([ntpath.basename(logfile), OFFSET_APPEND])
         #print("OFFSET FILE -> {}".format(self.offset_file))
 
-        (self.__first_line, self.__offset) = self.__get_current_offset()
-
-
+        self.fp = None
+        # identity of the file the offset belongs to, None if not known yet
+        self.__dev = None
+        self.__ino = None
+        self.__fingerprint_size = 0
+        self.__fingerprint = ""
+        # (st_mtime_ns, st_ctime_ns) of the open file at the previous scan
+        self.__times = None
+        # first line stored by an offset file of the previous format
+        self.__legacy_first_line = None
+        # True if the file was never read before (no checkpoint)
+        self.new = False
+        self.__offset = self.__get_last_offset()
 
     def __get_last_offset(self):
-        path = os.path.join(self.work_dir, self.offset_file)
-        first_line = ""
         offset = 0
+        checkpoint = self.store.get(self.name)
         try:
-            fp = open(path, "r")
-            first_line = fp.readline()[:-1]
-            offset = int(fp.readline())
-        except IOError:
+            if checkpoint is not None:
+                identity, position = checkpoint
+                self.__parse_identity(identity)
+                offset = int(position)
+            else:
+                offset = self.__get_legacy_offset()
+        except (IOError, ValueError):
+            self.new = True
             # print("\nRetroactive = {}".format(self.retroactive))
             # Retroactive param in config file is set to False
             if self.retroactive == False:
                 try:
-                    path = os.path.join(self.work_dir + "/..", self.logfile)
-                    fp = open(path, "rb")
-                    fp.seek(0, os.SEEK_END)
-                    offset = fp.tell()
-                    self.__offset = fp.tell()
-
-                    fp.seek(0, 0)
-                    self.__first_line = fp.readline().decode()[:-1]
-                    first_line = self.__first_line
-                    #print(self.__first_line)
-
-                    # GET LAST LINE
-                    # fp.seek(-2, os.SEEK_END)
-                    # while fp.read(1) != b'\n':
-                    #     fp.seek(-2, os.SEEK_CUR)
-                    # self.__first_line = fp.readline().decode()[:-1]
-                    # first_line = self.__first_line
-                    # print(self.__first_line)
-
-                    # Save the offset, else the offset file would never be created
+                    self.fp = open(self.path, "rb", buffering=0)
+                    st = os.fstat(self.fp.fileno())
+                    self.__dev, self.__ino = st.st_dev, st.st_ino
+                    offset = st.st_size
+
+                    # Save the offset, else the checkpoint would never be created
+                    self.__offset = offset
                     self.save_offset(offset)
                 except IOError as e:
                     #raise e
                     pass
-                pass
-            pass
 
         debug("__get_last_offset():")
-        debug("   first_line: %s", first_line)
+        debug("   identity: %s %s", self.__dev, self.__ino)
         debug("   offset: %ld", offset)
 
-        return first_line, offset
-
-    def __get_current_offset(self):
-        first_line = ""
-        offset = 0
-        try:
-            path = os.path.join(self.work_dir + "/..", self.logfile)
-            fp = open(path, "r")
-            first_line = fp.readline()[:-1]
-            fp.seek(0, 2)
-            offset = fp.tell()
-        except IOError as e:
-            print("EXCEPTION: {}".format(e))
-            pass
-
-        debug("__get_current_offset():")
-        debug("   first_line: %s", first_line)
-        debug("   offset: %ld", offset)
+        return offset
 
-        return first_line, offset
+    # identity is "st_dev st_ino fingerprint_size fingerprint"
+    def __parse_identity(self, identity):
+        fields = identity.split(" ")
+        self.__dev = int(fields[0])
+        self.__ino = int(fields[1])
+        self.__fingerprint_size = int(fields[2])
+        self.__fingerprint = fields[3]
+
+    def __get_legacy_offset(self):
+        fp = open(os.path.join(self.work_dir, self.offset_file), "r")
+        head = fp.readline()[:-1]
+        offset = int(fp.readline())
+        fp.close()
+        self.__legacy_first_line = head
+        return offset
 
-    def update_first_line(self):
-        first_line = ""
+    def __read_fingerprint(self, fd, size):
+        return hashlib.md5(os.pread(fd, size, 0)).hexdigest()
+
+    # Was the file, identified by its first bytes, already seen under the same inode
+    def __same_content(self, fd):
+        if self.__fingerprint_size == 0:
+            return True
+        return self.__read_fingerprint(fd, self.__fingerprint_size) == self.__fingerprint
+
+    # The open file was modified with an older time than at the previous scan
+    def __went_back(self, st):
+        if self.__times is None:
+            return True
+        return st.st_mtime_ns < self.__times[0] or st.st_ctime_ns < self.__times[1]
+
+    # The file we were reading before the daemon stopped, if logrotate renamed it
+    def __find_rotated(self):
+        for pattern in ROTATED_PATTERNS:
+            for candidate in sorted(glob.glob(pattern.format(glob.escape(self.path)))):
+                try:
+                    st = os.stat(candidate)
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino) == (self.__dev, self.__ino):
+                    return candidate
+        return None
+
+    # (file object, offset, rotated) of everything there is to read, in order.
+    # The handles of rotated files are closed by the caller once read,
+    # save_offset() is for the current file only.
+    def get_segments(self):
+        segments = []
         try:
-            fp = open(self.logfile, "r")
-            first_line = fp.readline()[:-1]
-        except IOError as e:
-            raise e
-
-        self.__first_line = first_line
+            st = os.stat(self.path)
+        except OSError:
+            # rotated away and not created again yet
+            st = None
+
+        if self.fp is not None:
+            fst = os.fstat(self.fp.fileno())
+            if st is None or (fst.st_dev, fst.st_ino) != (st.st_dev, st.st_ino):
+                print("Log file [{}] was rotated, draining the rest of it".format(self.logfile))
+                segments.append((self.fp, self.__offset, True))
+                self.fp = None
+                self.__dev = self.__ino = None
+                self.__fingerprint_size = 0
+                self.__offset = 0
+            elif fst.st_size < self.__offset or (self.__went_back(fst) and not self.__same_content(self.fp.fileno())):
+                # copytruncate, also when the file grew past the offset again since
+                # and its times were set back (e.g. a restored copy)
+                print("Log file [{}] was truncated, reading it from the beginning".format(self.logfile))
+                self.__offset = 0
+                self.__fingerprint_size = 0
+            if self.fp is not None:
+                self.__times = (fst.st_mtime_ns, fst.st_ctime_ns)
+
+        if self.fp is None and st is not None:
+            try:
+                self.fp = open(self.path, "rb", buffering=0)
+            except IOError as e:
+                print("EXCEPTION: {}".format(e))
+                return segments
+            self.__adopt(segments)
+
+        if self.fp is not None:
+            segments.append((self.fp, self.__offset, False))
+
+        debug("get_segments():")
+        debug("   segments: %s", [(offset, rotated) for fp, offset, rotated in segments])
+
+        return segments
+
+    # Checks the offset read from the offset file against the file just opened
+    def __adopt(self, segments):
+        fd = self.fp.fileno()
+        st = os.fstat(fd)
+
+        if self.__legacy_first_line is not None:
+            # offset file of the previous format, trust it only for the same first line
+            first_line = os.pread(fd, 65536, 0).split(b"\n", 1)[0].decode(errors="replace")
+            if first_line != self.__legacy_first_line:
+                self.__offset = 0
+            self.__legacy_first_line = None
+        elif self.__ino is not None and (st.st_dev, st.st_ino) != (self.__dev, self.__ino):
+            rotated = self.__find_rotated()
+            if rotated is not None:
+                print("Log file [{}] was rotated to [{}], draining the rest of it".format(self.logfile, rotated))
+                try:
+                    segments.append((open(rotated, "rb", buffering=0), self.__offset, True))
+                except IOError:
+                    pass
+            self.__offset = 0
+            self.__fingerprint_size = 0
+        elif not self.__same_content(fd):
+            # same inode number, another file
+            self.__offset = 0
+            self.__fingerprint_size = 0
+
+        if st.st_size < self.__offset:
+            # copytruncate while the daemon was not running
+            self.__offset = 0
+            self.__fingerprint_size = 0
+        self.__dev, self.__ino = st.st_dev, st.st_ino
+        self.__times = (st.st_mtime_ns, st.st_ctime_ns)
 
     def get_offset(self):
-        last_line, last_offset = self.__get_last_offset()
-
-        if last_line != self.__first_line:
-            # log file was rotated, start from beginning
-            offset = 0
-            #print("first")
-        elif self.__offset > last_offset:
-            # new lines exist in log file
-            offset = last_offset
-            #print("second")
-        else:
-            # no new entries in log file
-            offset = None
-            #print("third")
-
-        debug("get_offset():")
-        debug("   offset: %s", str(offset))
-
-        return offset
+        return self.__offset
 
     def save_offset(self, offset):
-        path = os.path.join(self.work_dir, self.offset_file)
-        try:
-            fp = open(path, "w")
-            fp.write("%s\n" % self.__first_line)
-            fp.write("%ld\n" % offset)
-            fp.close()
-        except IOError:
-            print("Could not save logfile offset to: %s" % path)
+        self.__offset = offset
+        if self.fp is not None and self.__fingerprint_size < FINGERPRINT_SIZE:
+            # the fingerprint grows with the file up to FINGERPRINT_SIZE
+            self.__fingerprint_size = min(FINGERPRINT_SIZE, offset)
+            self.__fingerprint = self.__read_fingerprint(self.fp.fileno(), self.__fingerprint_size)
+
+        identity = "%s %s %d %s" % (self.__dev, self.__ino, self.__fingerprint_size, self.__fingerprint or "-")
+        self.store.update(self.name, KIND_FILE, identity, offset)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
@@ -6,8 +6,9 @@ import os
 import sys
 import datetime
 import atexit
-import time, sched
-from signal import SIGTERM
+import time
+import signal
+from signal import SIGTERM, SIGHUP
 import re
 import fcntl
 import stat
@@ -15,6 +16,11 @@ import stat
 import comm_server
 from config import Prefs
 from rule_executor import RuleExecutor, DbWatcher
+from database import Database
+from action_executor import ActionExecutor
+from tailer import LogTailer
+from checkpoints import CheckpointStore
+from eventloop import EventLoop
 
 DATADIR = 'data/'
 CONFDIR = 'conf/'
@@ -22,9 +28,15 @@ LOGFILENAME = 'logfile.log'
 PIDFILENAME = 'pidfile.pid'
 CONFFILENAME = 'conf.conf'
 
+# LogTailer and RuleExecutor of the running daemon
+tailer = None
+engine = None
+
 class Daemon(object):
 	# Keep instance reference
 	_singletonInstance = None
+	# set by the first shutdown(), by a signal or at exit
+	_shuttingDown = False
 
 	def __new__(cls, *args, **kwargs):
 		if not cls._singletonInstance:
@@ -191,14 +203,54 @@ class Daemon(object):
 				print(str(err))
 				sys.exit(1)
 
+	# Writes the pending database rows before the process goes down. It runs on the
+	# signal watcher thread or at exit, never in a signal handler: the main thread may
+	# hold the flush locks of the database writer and of the checkpoints.
+	def shutdown(self, signum=None):
+		if Daemon._shuttingDown:
+			return
+		Daemon._shuttingDown = True
+		print("Flushing {} pending database writes".format(Database.getPendingCount()))
+		Database.flushPending()
+		CheckpointStore.flushPending()
+		# give the queued bans and unbans a chance to run, the SIGTERMs sent
+		# meanwhile by stop() stay blocked
+		ActionExecutor.drainPending(Prefs().getGeneralPref('ACTION_TIMEOUT', 60))
+		if signum != None:
+			# die the same way as without the watcher, the signal has
+			# no handler and is delivered to this thread once unblocked
+			signal.pthread_sigmask(signal.SIG_UNBLOCK, [signum])
+			os.kill(os.getpid(), signum)
+
+	# Reads the config file again without restarting. The reload runs on the EventLoop,
+	# between two scheduled calls, never under a scan it would rebuild.
+	def reload(self):
+		EventLoop.getInstance().callSoon(reloadConfig)
+
+	# SIGHUP and SIGTERM are blocked in every thread and taken here,
+	# out of any signal handler
+	def watchSignals(self):
+		while True:
+			signum = signal.sigwait([SIGHUP, SIGTERM])
+			if signum == SIGTERM:
+				self.shutdown(signum)
+			else:
+				self.reload()
+
 	def run(self):
 		print(datetime.datetime.today())
 		print("GoofyGoHome - launching")
 
+		# before any thread is started, they all inherit the mask
+		signal.pthread_sigmask(signal.SIG_BLOCK, [SIGHUP, SIGTERM])
+		threading.Thread(target=self.watchSignals, name="Signal watcher", daemon=True).start()
+		atexit.register(self.shutdown)
+
 		sock_path = Prefs().getGeneralPref('SOCKET_PATH')
 
-		# start DB watcher thread
-		dbWatcher = DbWatcher()
+		# the DB watcher and the daemon cycle share the scheduler run by this thread
+		loop = EventLoop.getInstance()
+		dbWatcher = DbWatcher(loop)
 		dbWatcher.start()
 		#dbWatcher.onThread(dbWatcher.checkEventsNow)
 
@@ -207,18 +259,36 @@ class Daemon(object):
 		t = threading.Thread(target=commServer.start, args=(sock_path, True), name="comm_server")
 		t.start()
 
+		# start the log file tailer, it scans a log file as soon as it changes
+		global tailer, engine
+		tailer = LogTailer(pollInterval=Prefs().getGeneralPref('DAEMON_SLEEP'),
+			useInotify=str(Prefs().getGeneralPref('LOG_WATCHER', 'inotify')).lower() != 'poll')
+		tailer.start()
+
+		# the rule engine is built once and lives as long as the daemon
+		engine = RuleExecutor(prefs=Prefs(), tailer=tailer)
+		engine.start()
+
 		# We don't start this immediately (with value 0)
 		# in order to prevent a havoc
-		s = sched.scheduler(time.time, time.sleep)
-		s.enter(2, 1, watchJournalFiles, (s,))
-		s.run()
+		loop.callLater(2, watchJournalFiles, loop)
+		loop.run()
+
 
 
+def reloadConfig():
+	if engine is not None:
+		engine.reload()
 
-def watchJournalFiles(sch):
-	ruleExecutor = RuleExecutor(prefs=prefs)
-	# run self again / recursion
-	sch.enter(Prefs().getGeneralPref('DAEMON_SLEEP'), 1, watchJournalFiles, (sch,))
+# Starts the journald watchers again if they died, scans the log files without a tailer
+def watchJournalFiles(loop):
+	try:
+		engine.tick()
+		# the positions of idle log files are saved at least once per cycle
+		CheckpointStore.flushPending()
+	finally:
+		# run self again / recursion, a failed cycle must not end the next ones
+		loop.callLater(Prefs().getGeneralPref('DAEMON_SLEEP'), watchJournalFiles, loop)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import functools
+import hashlib
+import ipaddress
+import mmap
+import ntpath
+import os
+import struct
+
+# Verdicts, same values as returned by rule_executor.checkIPenabled
+DENIED = 0
+ALLOWED = 1
+UNKNOWN = 2
+
+# Number of recent verdicts kept in the LRU cache
+VERDICT_CACHE_SIZE = 8192
+
+# Binary cache of a parsed hosts list file:
+# header (magic, source mtime in ns, source size, IPv4 count, IPv6 count)
+# followed by the IPv4 and then the IPv6 ranges as big-endian (start, end) pairs
+CACHE_APPEND = "._ranges"
+CACHE_MAGIC = b"GGHRNG01"
+CACHE_HEADER = struct.Struct(">8sQQQQ")
+ADDRESS_WIDTH = {4: 4, 6: 16}
+
+
+# Turns CIDR strings into (version, first address, last address) integer ranges
+def parseNetworks(networks):
+	for net in networks:
+		net = net.strip()
+		if net == "":
+			continue
+		try:
+			network = ipaddress.ip_network(net, strict=False)
+		except ValueError as e:
+			print("ERROR: Invalid network in hosts list -> {} ~ {}".format(net, e))
+			continue
+		yield (network.version, int(network.network_address), int(network.broadcast_address))
+
+
+# Sorted, merged and immutable integer ranges of one address family.
+# Membership is a binary search over the range starts.
+class RangeTable(object):
+	def __init__(self, ranges = ()):
+		starts = []
+		ends = []
+		for start, end in sorted(ranges):
+			if ends != [] and start <= ends[-1] + 1:
+				# overlapping or adjacent range, extend the previous one
+				if end > ends[-1]:
+					ends[-1] = end
+			else:
+				starts.append(start)
+				ends.append(end)
+		self._starts = tuple(starts)
+		self._ends = tuple(ends)
+
+	def contains(self, value):
+		i = bisect.bisect_right(self._starts, value) - 1
+		return i >= 0 and value <= self._ends[i]
+
+	def ranges(self):
+		return zip(self._starts, self._ends)
+
+	def __len__(self):
+		return len(self._starts)
+
+
+# Same as RangeTable, but the ranges stay in a memory-mapped cache file
+# and are only decoded during the binary search
+class MappedRangeTable(object):
+	def __init__(self, buf, offset, count, width):
+		self._buf = buf
+		self._offset = offset
+		self._count = count
+		self._width = width
+
+	def __start(self, i):
+		pos = self._offset + i * 2 * self._width
+		return int.from_bytes(self._buf[pos:pos + self._width], 'big')
+
+	def __end(self, i):
+		pos = self._offset + i * 2 * self._width + self._width
+		return int.from_bytes(self._buf[pos:pos + self._width], 'big')
+
+	def contains(self, value):
+		# bisect_right over the range starts
+		lo, hi = 0, self._count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if value < self.__start(mid):
+				hi = mid
+			else:
+				lo = mid + 1
+		return lo > 0 and value <= self.__end(lo - 1)
+
+	def __len__(self):
+		return self._count
+
+
+# Parses a hosts list file (one CIDR per line, # comments allowed) into a binary
+# cache in cacheDir and maps the cache. The text is parsed again only when
+# the mtime or size of the source file changes.
+def loadRangeFile(path, cacheDir):
+	st = os.stat(path)
+	cachePath = os.path.join(cacheDir, cacheName(path))
+
+	buf = _mapCache(cachePath, st)
+	if buf is None:
+		print("Building hosts list cache [{}] from [{}]".format(cachePath, path))
+		_writeCache(path, cachePath, st)
+		buf = _mapCache(cachePath, st)
+		if buf is None:
+			raise IOError("Unable to map hosts list cache {}".format(cachePath))
+
+	magic, mtime, size, count4, count6 = CACHE_HEADER.unpack_from(buf, 0)
+	offset6 = CACHE_HEADER.size + count4 * 2 * ADDRESS_WIDTH[4]
+	return {
+		4: MappedRangeTable(buf, CACHE_HEADER.size, count4, ADDRESS_WIDTH[4]),
+		6: MappedRangeTable(buf, offset6, count6, ADDRESS_WIDTH[6])
+	}
+
+# Lists of the same name in different directories get different caches
+def cacheName(path):
+	digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+	return ''.join([ntpath.basename(path), '.', digest, CACHE_APPEND])
+
+# returns the mapped cache if it is up to date with the source file, None otherwise
+def _mapCache(cachePath, st):
+	try:
+		with open(cachePath, "rb") as fp:
+			buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+	except (IOError, OSError, ValueError):
+		return None
+
+	if len(buf) < CACHE_HEADER.size:
+		buf.close()
+		return None
+	magic, mtime, size, count4, count6 = CACHE_HEADER.unpack_from(buf, 0)
+	expected = CACHE_HEADER.size + count4 * 2 * ADDRESS_WIDTH[4] + count6 * 2 * ADDRESS_WIDTH[6]
+	if magic != CACHE_MAGIC or mtime != st.st_mtime_ns or size != st.st_size or len(buf) != expected:
+		buf.close()
+		return None
+	return buf
+
+def _writeCache(path, cachePath, st):
+	ranges = {4: [], 6: []}
+	with open(path, "r", errors="replace") as fp:
+		lines = (line.split('#', 1)[0] for line in fp)
+		for version, start, end in parseNetworks(lines):
+			ranges[version].append((start, end))
+	tables = {4: RangeTable(ranges[4]), 6: RangeTable(ranges[6])}
+	del ranges
+
+	# write aside and rename, a crash never leaves a truncated cache behind
+	tmpPath = cachePath + ".tmp"
+	with open(tmpPath, "wb") as fp:
+		fp.write(CACHE_HEADER.pack(CACHE_MAGIC, st.st_mtime_ns, st.st_size, len(tables[4]), len(tables[6])))
+		for version in (4, 6):
+			width = ADDRESS_WIDTH[version]
+			for start, end in tables[version].ranges():
+				fp.write(start.to_bytes(width, 'big'))
+				fp.write(end.to_bytes(width, 'big'))
+	os.replace(tmpPath, cachePath)
+
+
+# Prebuilt index of HOSTS_ALLOW and HOSTS_DENY for IPv4 and IPv6.
+# allowTables and denyTables are extra per-family tables, e.g. loaded by loadRangeFile
+class HostsIndex(object):
+	def __init__(self, allow = (), deny = (), allowTables = (), denyTables = (), cacheSize = VERDICT_CACHE_SIZE):
+		self._allow = HostsIndex.__buildTables(allow, allowTables)
+		self._deny = HostsIndex.__buildTables(deny, denyTables)
+		self.check = functools.lru_cache(maxsize=cacheSize)(self.__lookup)
+
+	@staticmethod
+	def __buildTables(networks, extraTables):
+		ranges = {4: [], 6: []}
+		for version, start, end in parseNetworks(networks):
+			ranges[version].append((start, end))
+		tables = {4: [RangeTable(ranges[4])], 6: [RangeTable(ranges[6])]}
+		for extra in extraTables:
+			for version in (4, 6):
+				if len(extra[version]) > 0:
+					tables[version].append(extra[version])
+		return tables
+
+	@staticmethod
+	def __contains(tables, value):
+		for table in tables:
+			if table.contains(value):
+				return True
+		return False
+
+	# returns DENIED, ALLOWED or UNKNOWN, raises ValueError if ip is not an address
+	def __lookup(self, ip):
+		addr = ipaddress.ip_address(ip)
+		value = int(addr)
+
+		# HOSTS_ALLOW is privileged to HOSTS_DENY
+		if HostsIndex.__contains(self._allow[addr.version], value):
+			return ALLOWED
+		if HostsIndex.__contains(self._deny[addr.version], value):
+			return DENIED
+		return UNKNOWN
+
+	def getSizes(self):
+		count = lambda tables: sum(len(table) for table in tables)
+		return {
+			'allow' : {'ipv4' : count(self._allow[4]), 'ipv6' : count(self._allow[6])},
+			'deny' : {'ipv4' : count(self._deny[4]), 'ipv6' : count(self._deny[6])}
+		}
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Size of the blocks read from the log files
+READ_BLOCK = 1024 * 1024
+
+# Stripped from both ends of every line, as str.strip() did
+WHITESPACE = b" \t\r\n\x0b\x0c"
+
+NEWLINE = ord("\n")
+
+
+# Reads a binary stream in large blocks into one reused buffer and yields the
+# (start, end) bounds of lines in getBuffer(), nothing is decoded or copied per
+# line. Regexes search the buffer with pos and endpos, the matched distingueur
+# is the only thing decoded. The bounds are valid until the next line is taken.
+# A line longer than the buffer makes the buffer grow.
+class LineReader(object):
+	def __init__(self, fp, blockSize = READ_BLOCK):
+		self._fp = fp
+		self._buffer = bytearray(blockSize)
+		# bytes of the stream read as complete lines, and their number
+		self._consumed = 0
+		self._lineCount = 0
+
+	def getBuffer(self):
+		return self._buffer
+
+	def getConsumed(self):
+		return self._consumed
+
+	def getLineCount(self):
+		return self._lineCount
+
+	# Every line of the stream
+	def lines(self, limit = None, final = False):
+		buf = self._buffer
+		for complete in self.__blocks(limit, final):
+			pos = 0
+			while pos < complete:
+				newline = buf.find(b"\n", pos, complete)
+				if newline < 0:
+					newline = complete
+				start, end = self.__strip(pos, newline)
+				if end > start:
+					yield start, end
+				pos = newline + 1
+
+	# Only the lines containing a match of pattern (bytes, not anchored). The pattern
+	# runs over the whole block, the other lines are skipped without being looked at.
+	def candidates(self, pattern, limit = None, final = False):
+		buf = self._buffer
+		for complete in self.__blocks(limit, final):
+			m = pattern.search(buf, 0, complete)
+			while m is not None:
+				start = buf.rfind(b"\n", 0, m.start()) + 1
+				newline = buf.find(b"\n", m.start(), complete)
+				if newline < 0:
+					newline = complete
+				start, end = self.__strip(start, newline)
+				if end > start:
+					yield start, end
+				m = pattern.search(buf, newline + 1, complete)
+
+	# Bounds of the line without the whitespace around it. The last byte of the leading
+	# whitespace of an indented line is overwritten with a newline, so that ^ (MULTILINE)
+	# matches at its new start as it did on the stripped line.
+	def __strip(self, start, end):
+		buf = self._buffer
+		while end > start and buf[end - 1] in WHITESPACE:
+			end -= 1
+		first = start
+		while first < end and buf[first] in WHITESPACE:
+			first += 1
+		if first > start:
+			buf[first - 1] = NEWLINE
+		return first, end
+
+	# Fills the buffer with the next limit bytes of the stream (all of it if None) and yields
+	# the length of its part made of complete lines. The last line without a newline is only
+	# part of it if final is True, else it stays unread (the log file is being written to)
+	# and getConsumed() ends before it.
+	def __blocks(self, limit, final):
+		fp = self._fp
+		buf = self._buffer
+		filled = 0
+		eof = False
+		while not eof:
+			if filled == len(buf):
+				# the line does not fit in the buffer
+				buf.extend(bytes(len(buf)))
+			want = len(buf) - filled
+			if limit is not None:
+				want = min(want, limit)
+			n = 0
+			if want > 0:
+				with memoryview(buf)[filled:filled + want] as view:
+					n = fp.readinto(view) or 0
+			if n == 0:
+				eof = True
+			filled += n
+			if limit is not None:
+				limit -= n
+
+			complete = buf.rfind(b"\n", 0, filled) + 1
+			if eof and final and complete < filled:
+				complete = filled
+				self._lineCount += 1
+			if complete == 0:
+				continue
+			self._lineCount += buf.count(b"\n", 0, complete)
+			yield complete
+
+			# the partial line moves to the beginning of the buffer
+			self._consumed += complete
+			buf[:filled - complete] = buf[complete:filled]
+			filled -= complete
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+
+try:
+	import re._parser as sre_parse
+	import re._constants as sre_constants
+except ImportError:
+	import sre_parse
+	import sre_constants
+
+# Literals shorter than this are not worth a prefilter pass
+MIN_LITERAL_LENGTH = 3
+
+
+# Returns the longest literal substring every match of the regex has to contain,
+# None if no such literal can be determined (or the regex is case insensitive)
+def extractRequiredLiteral(regex):
+	try:
+		parsed = sre_parse.parse(regex)
+	except Exception:
+		return None
+
+	if parsed.state.flags & (sre_constants.SRE_FLAG_IGNORECASE | sre_constants.SRE_FLAG_VERBOSE):
+		return None
+
+	runs = []
+	_collectRuns(parsed, runs)
+	runs = [run for run in runs if len(run) >= MIN_LITERAL_LENGTH]
+	if runs == []:
+		return None
+	return max(runs, key=len)
+
+# Walks the parsed regex and collects runs of consecutive literals which are
+# mandatory for a match. Anything optional or alternative breaks the run.
+def _collectRuns(parsed, runs):
+	current = []
+	for op, av in parsed:
+		if op == sre_constants.LITERAL:
+			current.append(chr(av))
+			continue
+
+		if current != []:
+			runs.append(''.join(current))
+			current = []
+
+		if op == sre_constants.SUBPATTERN:
+			# (group, add_flags, del_flags, pattern)
+			if av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+				continue
+			_collectRuns(av[-1], runs)
+		elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+			# (min, max, pattern) - the content is mandatory only if it repeats at least once
+			if av[0] >= 1:
+				_collectRuns(av[2], runs)
+
+	if current != []:
+		runs.append(''.join(current))
+
+
+# Rejects lines that cannot match any rule of a service.
+# A combined alternation of the literals required by the rules is searched
+# once per line, lines without any of them are dropped before any per-rule
+# regex runs. If a rule has no usable literal, every line is a candidate.
+# Log files are read as bytes, there the alternation runs over whole blocks.
+class Prefilter(object):
+
+	def __init__(self, rules):
+		self._literals = {}
+		self._bytesLiterals = {}
+		self._combined = None
+		self._combinedBytes = None
+		self._hits = 0
+		self._misses = 0
+
+		for rule in rules:
+			if rule.getCompiledRegex() is None:
+				continue
+			self._literals[rule] = extractRequiredLiteral(rule.getRegex())
+			self._bytesLiterals[rule] = self._literals[rule].encode() if self._literals[rule] is not None else None
+
+		literals = list(self._literals.values())
+		if literals != [] and None not in literals:
+			# longest first, so that the alternation prefers the most specific literal
+			alternation = '|'.join(re.escape(lit) for lit in sorted(set(literals), key=len, reverse=True))
+			self._combined = re.compile(alternation)
+			self._combinedBytes = re.compile(alternation.encode())
+
+	def isActive(self):
+		return self._combined is not None
+
+	# True if the line may match at least one rule
+	def check(self, line):
+		if self._combined is None:
+			return True
+
+		# Counters are only touched by the thread scanning the service
+		if self._combined.search(line) is not None:
+			self._hits += 1
+			return True
+
+		self._misses += 1
+		return False
+
+	# True if the line contains the literal required by this particular rule
+	def ruleMayMatch(self, rule, line):
+		literal = self._literals.get(rule)
+		if literal is None:
+			return True
+		return literal in line
+
+	# Bounds of the lines of a LineReader which may match at least one rule,
+	# the combined alternation runs over whole blocks of the log file
+	def candidates(self, reader, final = False):
+		if self._combinedBytes is None:
+			return reader.lines(final=final)
+		return self.__countCandidates(reader, final)
+
+	def __countCandidates(self, reader, final):
+		lineCount = reader.getLineCount()
+		hits = 0
+		for bounds in reader.candidates(self._combinedBytes, final=final):
+			hits += 1
+			yield bounds
+		self._hits += hits
+		self._misses += reader.getLineCount() - lineCount - hits
+
+	# ruleMayMatch() of the line buf[start:end]
+	def ruleMayMatchRange(self, rule, buf, start, end):
+		literal = self._bytesLiterals.get(rule)
+		if literal is None:
+			return True
+		return buf.find(literal, start, end) >= 0
+
+	def getLiterals(self):
+		return self._literals
+
+	def getBytesLiterals(self):
+		return self._bytesLiterals
+
+	# Pattern of the combined alternation (bytes), None if the prefilter is inactive
+	def getBytesPattern(self):
+		return self._combinedBytes.pattern if self._combinedBytes is not None else None
+
+	def getHits(self):
+		return self._hits
+
+	def getMisses(self):
+		return self._misses
+
+	def getStats(self):
+		return {
+			'active' : self.isActive(),
+			'hits' : self._hits,
+			'misses' : self._misses,
+			'literals' : dict((rule.getRulename(), lit) for rule, lit in self._literals.items())
+		}
@@ -3,12 +3,13 @@
 
 import os
 import re
+import sys
 import time
+import functools
 import threading
-import ipaddress
 from threading import Thread
-import queue
 import select
+from collections import OrderedDict
 
 try:
 	from systemd import journal
@@ -16,386 +17,769 @@ except ImportError:
     sys.stderr.write("Missing `systemd` package: pip install systemd\n")
     sys.exit(1)
 
-from config import Prefs, Service, Rule, ServicesManager
+from config import Prefs, Service, Rule, ServicesManager, DEFAULT_REGEX_FIELD
 from run_command import Utils
 from filetracker import FileTracker
 from database import Database
-
-
-class DbWatcher(Thread):
-	def __init__(self, q = queue.Queue(10), loop_time = 1.0/60):
+from action_executor import ActionExecutor
+from tailer import resolveLogfile
+from backfill import backfill, alignEnd
+from linereader import LineReader
+from archives import findLiveFiles, findArchives, openArchive, archiveIdentity
+from checkpoints import CheckpointStore, KIND_ARCHIVE, KIND_JOURNALD
+from eventloop import EventLoop, Mailbox
+
+# Checkpoint of the journald reader shared by all the journald services
+JOURNALD_CHECKPOINT = "journald"
+# Methods of python-systemd's Reader that read single fields, they are not part of its public API
+JOURNAL_PRIVATE_API = ('_next', '_get', '_get_cursor', '_get_realtime', '_convert_field')
+
+
+# Releases the expired events. It lives on the EventLoop: one timed call at the next
+# expiration (at the latest after DB_EVENT_CHECK_SLEEP), moved earlier when an event
+# expiring before all others is stored. Other threads talk to it through its mailbox.
+class DbWatcher(object):
+	def __init__(self, loop = None):
 		print("DB Watcher initialized")
-		super(DbWatcher, self).__init__()
 		self.name = "DB Watcher"
-		self.q = q
+		self._loop = loop if loop is not None else EventLoop.getInstance()
+		self.mailbox = Mailbox(self.name, self._loop)
 		self.db = Database()
-		self.timeout = loop_time
-		# Get DB_EVENT_CHECK_SLEEP value from config file
+		# Get DB_EVENT_CHECK_SLEEP value from config file,
+		# it is the longest time we sleep without looking at the events
 		self._sleeptime = Prefs().getGeneralPref('DB_EVENT_CHECK_SLEEP')
-		self.isTimed = False
+		self._check = None
+		# A new event expiring before all others wakes us up
+		Database.setExpiryListener(self.wakeUp)
 		pass
 
+	def start(self):
+		self.onThread(self.schedule)
+
 	def onThread(self, function, *args, **kwargs):
-		self.q.put((function, args, kwargs))
+		self.mailbox.post(function, *args, **kwargs)
 
-	def run(self):
+	def wakeUp(self):
+		self.onThread(self.schedule)
 
-		while True:
-			try:
-				function, args, kwargs = self.q.get(timeout=self.timeout)
-				function(*args, **kwargs)
-				print(self.q)
-
-			except queue.Empty:
-				if self.isTimed == False:
-					self.isTimed = True
-					timerThread = threading.Timer(self._sleeptime, self.helperThreadSetIsTimed)
-					timerThread.setName("DbWatcher Timer")
-					timerThread.start()
-
-					self.checkEventsNow()
-				pass
+	# Seconds until the next event expires, bounded by DB_EVENT_CHECK_SLEEP
+	def secondsToNextExpiry(self):
+		nextExpiry = self.db.getNextExpiry()
+		if nextExpiry is None:
+			return self._sleeptime
+		return min(max(nextExpiry - time.time(), 0), self._sleeptime)
+
+	def schedule(self):
+		if self._check is not None:
+			self._check.cancel()
+		self._check = self._loop.callLater(self.secondsToNextExpiry(), self.checkEvents)
+
+	def checkEvents(self):
+		self._check = None
+		try:
+			# release only if something is due
+			nextExpiry = self.db.getNextExpiry()
+			if nextExpiry is not None and nextExpiry <= time.time():
+				self.checkEventsNow()
+		finally:
+			# the next check is planned even if this one failed
+			self.schedule()
 
 	def checkEventsNow(self):
 		print("[DbWatcher] Checking events validity ...")
 		self.db.checkLifeOfEvents()
 		pass
 
-	def helperThreadSetIsTimed(self):
-		self.isTimed = False
-
 
+# Everything the scan of one service needs, computed once per (re)load of the config
+class ServicePipeline(object):
+	def __init__(self, service):
+		self.name = service.getName()
+		self.logfile = service.getLogfile()
+		self.retroactive = service.getRetroactive()
+		self.rules = []
+		for rule in service.getRules():
+			# set ServiceName, we need this for the DB and journald search method
+			rule.setNameOfBelongService(service.getName())
+			if str(rule.getEnabled()).lower() == "true":
+				self.rules.append(rule)
+
+		self.prefilter = service.getPrefilter()
+		if self.prefilter is None:
+			self.prefilter = service.buildPrefilter()
+
+		# Patterns (bytes, as the log files are read) and distinguisher groups
+		# are resolved once at config load
+		self.compiledRules = [(rule, rule.getCompiledBytesRegex(), rule.getCriteriaGroupIndex(), rule.getEffectiveThresholdCount())
+			for rule in self.rules if rule.getCompiledBytesRegex() is not None]
+
+		# path -> FileTracker of every log file, created with its first scan
+		self.trackers = {}
+
+		# journald: the fields of the entries the rules look at, the combined
+		# prefilter is for MESSAGE only
+		self.journalFields = set(['_SYSTEMD_UNIT'])
+		for rule in self.rules:
+			self.journalFields |= rule.getJournalFields()
+		self.prefilterMessage = all(rule.getRegexField() == DEFAULT_REGEX_FIELD for rule in self.rules)
+
+	def isJournald(self):
+		return self.logfile == "journald"
+
+	# LOG_LOCATION may be a glob pattern matching several log files and their archives
+	def getPattern(self):
+		return resolveLogfile(self.logfile)
+
+	# The log files being written to, archives are not part of them
+	def getPaths(self):
+		return findLiveFiles(self.getPattern())
+
+
+# Long-lived engine built once by the daemon. The pipelines of the services, the journald
+# watchers, the open log handles (kept by the tailer) and the counters of the rules
+# live as long as the engine, reload() rebuilds them from the config file.
 class RuleExecutor(object):
-	def __init__(self, prefs = None):
-		self._prefs = prefs
+	def __init__(self, prefs = None, tailer = None):
+		self._prefs = prefs if prefs is not None else Prefs()
 		self.db = Database()
-		self.threadNames = []
-
+		self.tailer = tailer
+		# service name -> ServicePipeline, for the services with enabled rules
+		self.pipelines = {}
+		# one reader for all the journald services
+		self.journaldWatcher = None
+		self._lock = threading.RLock()
+		# paths whose backlog is being counted by the backfill workers
+		self._backfilling = set()
+		self.build()
+
+	def build(self):
+		pipelines = {}
 		for service in ServicesManager().getAllServices():
-			crnt_rules = []
-			for rule in service.getRules():
-				# set ServiceName, we need this for the DB and journald search method
-				rule.setNameOfBelongService(service.getName())
-				# strip first and last double quote
-				if rule.getRegex().startswith('"') and rule.getRegex().endswith('"'):
-					rule.setRegex(str(rule.getRegex())[1:-1])
-					# replacable with re.sub(r'^"|"$', '', rule.getRegex()) --- performance???
-				#print rule.getId()
-				#print(service.getName() + ": " + str(rule.getRulename()))
-				if (rule.getEnabled()).lower() == "true":
-					crnt_rules.append(rule)
-
-			
 			logfile = service.getLogfile()
 			#print("LOGFILE -> {}".format(logfile))
 			if logfile == None or logfile == "":
 				continue
+			pipeline = ServicePipeline(service)
+			if pipeline.rules != []:
+				pipelines[pipeline.name] = pipeline
+		self.pipelines = pipelines
+
+	# Hands the log files over to the tailer and starts the journald watchers
+	def start(self):
+		with self._lock:
+			self.startJournaldWatcher()
+			for pipeline in self.pipelines.values():
+				if not pipeline.isJournald() and self.tailer is not None:
+					self.watchFiles(pipeline)
+
+	# scanned by the tailer thread as soon as the file changes,
+	# watching a file again does nothing
+	def watchFiles(self, pipeline):
+		for path in pipeline.getPaths():
+			self.tailer.watch(path, functools.partial(self.scanFile, pipeline.name, path))
+
+	# One daemon cycle: scans the log files if there is no tailer (or hands over
+	# the new files of a glob to it) and starts the journald watchers again if they died
+	def tick(self):
+		with self._lock:
+			self.startJournaldWatcher()
+			pipelines = list(self.pipelines.values())
+		# every scan takes the lock itself, only once, see backfill()
+		for pipeline in pipelines:
+			if pipeline.isJournald():
+				continue
+			elif self.tailer is None:
+				self.scanService(pipeline.name)
+			else:
+				self.watchFiles(pipeline)
 
-			elif logfile != "journald":
-				if crnt_rules != []:
-					self.execute_search(logfile=logfile, rules_list=crnt_rules, rtrctv=service.getRetroactive())
+	def getJournaldPipelines(self):
+		return [pipeline for pipeline in self.pipelines.values() if pipeline.isJournald()]
 
-			elif logfile == "journald":
-				self.threadNames = [t.getName() for t in threading.enumerate()]
-				#print(self.threadNames)
+	def startJournaldWatcher(self):
+		if self.journaldWatcher is not None and self.journaldWatcher.is_alive():
+			return
+		pipelines = self.getJournaldPipelines()
+		if pipelines == []:
+			return
+		# start Journald watcher thread
+		self.journaldWatcher = Journald_watcher(pipelines)
+		self.journaldWatcher.start()
+
+	def scanService(self, name):
+		with self._lock:
+			pipeline = self.pipelines.get(name)
+			if pipeline is not None:
+				for path in pipeline.getPaths():
+					self.execute_search(pipeline, path)
+
+	def scanFile(self, name, path):
+		with self._lock:
+			pipeline = self.pipelines.get(name)
+			if pipeline is not None:
+				self.execute_search(pipeline, path)
+
+	# Loads the config file again and rebuilds the pipelines.
+	# A rule which still counts the same way keeps its counter.
+	# Returns False if the file could not be loaded, nothing changes then.
+	def reload(self):
+		with self._lock:
+			print("Reloading configuration from [{}]".format(Prefs.getConfigFile()))
+			oldRules = {}
+			oldTrackers = {}
+			for pipeline in self.pipelines.values():
+				for rule in pipeline.rules:
+					oldRules[(pipeline.name, rule.getRulename())] = rule
+				oldTrackers.update(pipeline.trackers)
 
-				if service.getName() not in self.threadNames:
-					#print("Thread {} is not in the list yet.".format(service.getName()))
-					if crnt_rules != []:
-						# start Journald watcher thread
-						jd_thread = Journald_watcher(name=service.getName(), rule_list=crnt_rules, retroactive=service.getRetroactive())
-						jd_thread.start()
-				pass
-		pass
+			try:
+				self._prefs.load_prefs(Prefs.getConfigFile())
+			except (IOError, OSError, ValueError) as e:
+				print("ERROR: Configuration could not be reloaded, the old one stays ~ {}".format(e))
+				return False
+			self.build()
+
+			for pipeline in self.pipelines.values():
+				for rule in pipeline.rules:
+					oldRule = oldRules.get((pipeline.name, rule.getRulename()))
+					if oldRule is not None:
+						rule.adoptCounter(oldRule)
+				if not pipeline.isJournald():
+					# same file, same handle and offset
+					for path in pipeline.getPaths():
+						tracker = oldTrackers.pop(path, None)
+						if tracker is not None and tracker.retroactive == pipeline.retroactive:
+							pipeline.trackers[path] = tracker
+						elif tracker is not None:
+							tracker.close()
+
+			# the running journald reader switches to the new pipelines,
+			# start() below creates it if there was no journald service before
+			if self.journaldWatcher is not None and self.journaldWatcher.is_alive():
+				self.journaldWatcher.setPipelines(self.getJournaldPipelines())
+
+			# files no longer configured
+			for path, tracker in oldTrackers.items():
+				tracker.close()
+				if self.tailer is not None:
+					self.tailer.unwatch(path)
+			self.start()
+			return True
 
 	# Takes care for rule application and enforcement on "classical" log files
-	def execute_search(self, logfile, rules_list, rtrctv):
+	def execute_search(self, pipeline, path):
+		if path in self._backfilling:
+			# the backfilling scan reads what is new once its workers are done
+			return
 
-		file_tracker = FileTracker(logfile, rtrctv)
-		last_offset = file_tracker.get_offset()
-		tmp_offset = last_offset
-		#print("LAST OFFSET -> {}".format(last_offset))
+		# (rule, distingueur) pairs which crossed the threshold during this scan
+		due = OrderedDict()
+		scanned = False
+
+		file_tracker = pipeline.trackers.get(path)
+		if file_tracker is None:
+			# the tracker keeps the file open between the scans
+			file_tracker = FileTracker(path, pipeline.retroactive)
+			pipeline.trackers[path] = file_tracker
+			if file_tracker.new and pipeline.retroactive:
+				# history kept in the rotated (compressed) siblings comes first
+				scanned = self.scanArchives(pipeline, path, due)
+		logfile = file_tracker.logfile
+
+		# the rest of a rotated file comes before the current one
+		for fp, last_offset, rotated in file_tracker.get_segments():
+			size = os.fstat(fp.fileno()).st_size
+			if size <= last_offset:
+				if rotated:
+					fp.close()
+				continue
 
-		# there are new entries in the logfile
-		if last_offset is not None:
+			# there are new entries in the logfile
 			print("Processing log file [{}] from offset [{}]".format(logfile, last_offset))
+			if not rotated and self.isWorthBackfill(size - last_offset):
+				# a large backlog is scanned in parallel, the lines
+				# written meanwhile are scanned below as usual
+				last_offset = self.backfill(pipeline, path, last_offset, size, due)
+				if last_offset is None:
+					# the config was reloaded meanwhile
+					return self.rescan(pipeline.name, path, due)
+			fp.seek(last_offset)
+			# the last line of the current file may still be being written
+			consumed = self.scanLines(pipeline, fp, due, final=rotated)
+			scanned = True
+
+			if rotated:
+				fp.close()
+			else:
+				file_tracker.save_offset(last_offset + consumed)
 
-			fp = None
+		if not scanned:
+			return
 
+		self.imposeSanctions(due)
+
+		for rule in pipeline.rules:
+			print("{}: {} distingueurs counted".format(rule.getRulename(), len(rule.getCounter())))
+
+	# Play the rules, distingueurs of batched rules are collected for the whole cycle
+	def imposeSanctions(self, due):
+		batches = {}
+		for rule, element in due:
+			sanction(rule, element, self.db, batches)
+		submitBatches(batches)
+
+	# Scan of path by the pipeline which replaced the one whose backfill was dropped,
+	# from the saved offset. The sanctions due from the archives are imposed first.
+	def rescan(self, name, path, due):
+		self.imposeSanctions(due)
+		pipeline = self.pipelines.get(name)
+		if pipeline is not None and path in pipeline.getPaths():
+			self.execute_search(pipeline, path)
+
+	def isWorthBackfill(self, backlog):
+		workers = int(self._prefs.getGeneralPref('BACKFILL_WORKERS', os.cpu_count() or 1))
+		return workers > 1 and backlog >= int(self._prefs.getGeneralPref('BACKFILL_MIN_MB', 64)) * 1024 * 1024
+
+	# Counts the hits of [start, end) of the log file in a process pool and feeds the
+	# merged counts to the counters of the rules, as a single pass would have done:
+	# all of them at the current time, whatever the age of the lines (see conf.conf).
+	# The engine lock, held once by the caller, is released while the workers run so
+	# that a reload and the daemon cycle on the EventLoop are not blocked by a long
+	# backfill on the tailer thread. The other log files still wait, they are scanned
+	# by the thread running the backfill.
+	# Returns the offset where the live scan goes on, None if the pipeline was
+	# replaced by a reload meanwhile (the counts are dropped then).
+	def backfill(self, pipeline, path, start, end, due):
+		end = alignEnd(path, start, end)
+		literals = pipeline.prefilter.getBytesLiterals()
+		specs = [(regex.pattern, regex.flags, group_index, literals.get(rule))
+			for rule, regex, group_index, threshold_count in pipeline.compiledRules]
+		workers = int(self._prefs.getGeneralPref('BACKFILL_WORKERS', os.cpu_count() or 1))
+		combined = pipeline.prefilter.getBytesPattern()
+
+		self._backfilling.add(path)
+		self._lock.release()
+		try:
+			merged = backfill(path, start, end, combined, specs, workers)
+		finally:
+			self._lock.acquire()
+			self._backfilling.discard(path)
+		if self.pipelines.get(pipeline.name) is not pipeline:
+			return None
+
+		for (rule, regex, group_index, threshold_count), counts in zip(pipeline.compiledRules, merged):
+			for ipaddr, hits in counts.items():
+				try:
+					verdict = checkIPenabled(ipaddr)
+					if verdict == 1:
+						continue
+					cnt = rule.hitDistingueur(ipaddr, weight=hits)
+				except:
+					continue
+				if verdict == 0 or cnt >= threshold_count:
+					due[(rule, ipaddr)] = True
+		return end
+
+	# Scans the archives of a log file matched by the glob of LOG_LOCATION, oldest first,
+	# when the log file is read for the first time. Every scanned archive gets a checkpoint,
+	# so that a scan interrupted by a restart goes on with the next archive.
+	def scanArchives(self, pipeline, path, due):
+		store = CheckpointStore.getInstance()
+		scanned = False
+		for archive in findArchives(path, pipeline.getPattern()):
 			try:
-				if logfile.startswith('/'):
-					fp = open(logfile, "r")
-				else:
-					relpath = os.path.dirname(os.path.realpath(__file__)) + '/' + logfile
-					fp = open(relpath, "r")
-
-				fp.seek(last_offset)
-			except IOError:
-				print("File pointer not obtained. ~Return")
-				return
-				pass
-
-			# Play the rules
-			for rule in rules_list:
-				regexyolo = re.compile(rule.getRegex())
-				#print(service.getName() + ": " + str(rule.getName()))
-				threshold_count = rule.getThresholdCount() if rule.getThresholdCount() != None else self.prefs.getGeneralPref('THRESHOLDCOUNT')
-
-				for line in fp:
-					line = line.strip()
-					r1 = regexyolo.search(line)
-					if r1 is not None:
-						#print "yes"
-						try:
-							ipaddr = r1.group(rule.getCriteriaToDistinguish())
-							#print(ipaddr)
-							# Check if detected event is not apriori enabled in HOSTS_ALLOW
-							if checkIPenabled(ipaddr) == 1:
-								continue
-							
-							dictx = rule.getIpXoccurDict()
-							ipcnt = dictx.get(ipaddr, 0) # 0 is the default value if key does not exist
-							#print("ipaddr {} / {}".format(ipaddr, ipcnt))items
-							rule.updateIpXoccur(ipaddr, ipcnt + 1)
-						except:
-							pass
-
-				if self.is_last(rule, rules_list) == False:
-					print("rules_list has more, seeking back to last_offset")
-					fp.seek(last_offset)
-
-				tempAction = rule.getAction()
-				tempAntiaction = rule.getAntiaction()
-				for element, cnt in rule.getIpXoccurDict().items():
-					# IP is in HOSTS_DENY or THRESHOLD value has been exceeded
-					if checkIPenabled(element) == 0 or cnt >= int(threshold_count):
-						#print("Threshold count -> {}".format(threshold_count))
-						#print("OccurenceCount after this read -> {}".format(cnt))
+				identity = archiveIdentity(archive)
+				if store.get(archive) == (identity, "done"):
+					continue
+				print("Processing archive [{}]".format(archive))
+				with openArchive(archive) as fp:
+					self.scanLines(pipeline, fp, due, final=True)
+			except (IOError, OSError, EOFError, ValueError) as e:
+				print("ERROR: Archive [{}] could not be read ~ {}".format(archive, e))
+				continue
+			store.update(archive, KIND_ARCHIVE, identity, "done")
+			scanned = True
+		return scanned
+
+	# Single pass over the new chunk of the log file, every enabled rule
+	# of the service is tested against each line. The file is read in large
+	# blocks and matched as bytes, only the distingueurs are decoded.
+	# Returns the number of bytes scanned.
+	def scanLines(self, pipeline, fp, due, final = False):
+		compiled_rules = pipeline.compiledRules
+		prefilter = pipeline.prefilter
+		reader = LineReader(fp)
+		buf = reader.getBuffer()
+
+		# Most lines match nothing, they are rejected before any rule regex runs
+		for start, end in prefilter.candidates(reader, final=final):
+			for rule, regexyolo, group_index, threshold_count in compiled_rules:
+				if not prefilter.ruleMayMatchRange(rule, buf, start, end):
+					continue
+				r1 = regexyolo.search(buf, start, end)
+				if r1 is not None:
+					#print "yes"
+					try:
+						ipaddr = r1.group(group_index).decode(errors="replace")
+						#print(ipaddr)
+						# Check if detected event is not apriori enabled in HOSTS_ALLOW
+						verdict = checkIPenabled(ipaddr)
+						if verdict == 1:
+							continue
 						
-						# Replace CRITERIA_TO_DISTINGUISH group placeholder in Regex
-						if tempAction != None:
-							replaced1 = re.sub(rule.getCriteriaToDistinguish(), str(element), tempAction)
-							rule.setAction(replaced1)
-
-							# check if such a tuple (rule,distingueur) is already in database
-							# if it is, we do not want to apply ACTION and ANTIACTION again
-							# nor we want to log this event to events table, only eventlog
-							if self._prefs.getGeneralPref('DO_NOT_DUPLICATE').lower() == 'true':
-								if self.db.checkDistingueurDetectedForRule(element, rule.getRulename()) == False:
-									# Run the action, let it roll baby
-									print("Executing ACTION -> {}".format(rule.getAction()))
-									Utils.execute_action(rule.getAction())
-								else:
-									print("DO_NOT_DUPLICATE is ON -> skipping ACTION")
-							else:
-								# Run the action, let it roll baby
-								print("Executing ACTION -> {}".format(rule.getAction()))
-								Utils.execute_action(rule.getAction())
-
-						if tempAntiaction != None:
-							replaced2 = re.sub(rule.getCriteriaToDistinguish(), str(element), tempAntiaction)
-							rule.setAntiaction(replaced2)
-
-							#print(rule.getAntiaction())
-
-						if self._prefs.getGeneralPref('DO_NOT_DUPLICATE').lower() == 'true':
-							if self.db.checkDistingueurDetectedForRule(element, rule.getRulename()) == False:
-								# Add event to DB
-								if rule.getAntiaction() != None:
-									self.db.addEvent(rule.getNameOfBelongService(), rule.getRulename(), element, time.asctime(), 
-										rule.getJailtime() if rule.getJailtime() != None else self._prefs.getGeneralPref('JAILTIME'), rule.getAntiaction())
-							else:
-								print("DO_NOT_DUPLICATE is ON -> skipping DB store to events.")
-
-						self.db.addEventlog(rule.getNameOfBelongService(), rule.getRulename(), element, time.asctime())
-
-						# We imposed a sanction, now we reset the counter
-						rule.updateIpXoccur(element, 0)
-
-
-				print("{}: IP X OCCUR DICT -> {}".format(rule.getRulename(), rule.getIpXoccurDict()))
-
-
-			last_offset = fp.tell()
-			#print(last_offset)
-			fp.close()
-
-			if last_offset != tmp_offset:
-				file_tracker.save_offset(last_offset)
-				tmp_offset = last_offset
-			else:
-				print("Log file size has not changed. Nothing to do.")
-
-	# Way to check if the rule is the last one in the particular service to be applied
-	def is_last(self, rule, rules_list):
-		curr_index = rules_list.index(rule)
-		#print("CURR = {} at position {}".format(rules_list[curr_index].getRulename(), curr_index))
-		try:
-			next = rules_list[curr_index+1]
-			#print("NEXT = {} at position {}".format(next.getRulename(), curr_index+1))
-			return False
-		except IndexError:
-			#print("OUT OF INDEX, return True, we are the last one")
-			next = None
-			return True
-		return
-
-
+						cnt = rule.hitDistingueur(ipaddr)
+					except:
+						continue
+
+					# IP is in HOSTS_DENY or THRESHOLD value has been exceeded,
+					# only the counter bumped right now is checked
+					if verdict == 0 or cnt >= threshold_count:
+						due[(rule, ipaddr)] = True
+
+		return reader.getConsumed()
+
+
+# One reader for the journal entries of all the journald services of the config. Its
+# matches are the _SYSTEMD_UNIT of every service (matches of the same field are ORed),
+# each entry is routed to the pipeline of its unit by a dict lookup.
+# The cursor of the last processed entry is kept in the CheckpointStore, a restarted
+# daemon goes on right after it. Without a checkpoint the reading starts at the end
+# of the journal, or at its beginning if a service has RETROACTIVE = true (the older
+# entries of the other services are then skipped). The entries are drained in batches,
+# the cursor is saved after every JOURNALD_BATCH_SIZE entries or CHECKPOINT_INTERVAL
+# seconds and at the end of each drain.
 class Journald_watcher(Thread):
-	def __init__(self, rule_list, name = "", retroactive = False, q = queue.Queue(10), loop_time = 1.0/60):
-		print("Journald watcher [{}] initialized".format(name))
+	def __init__(self, pipelines):
+		print("Journald watcher initialized for [{}]".format(", ".join(pipeline.name for pipeline in pipelines)))
 		super(Journald_watcher, self).__init__()
 		self._prefs = Prefs()
 		self.db = Database()
-		self.name = name
-		self.q = q
-		self.rules = rule_list
-		#print(self.rules)
-		self.retroactive = retroactive
+		self.name = "Journald watcher"
+		# distingueurs of batched rules, submitted after each batch of entries
+		self.batches = {}
+		self._batchSize = int(self._prefs.getGeneralPref('JOURNALD_BATCH_SIZE', 500))
+		self._checkpointInterval = int(self._prefs.getGeneralPref('CHECKPOINT_INTERVAL', 5))
+		self.store = CheckpointStore.getInstance()
+		self._cursor = None
+		# entries older than this are only for the RETROACTIVE services, None if all are
+		self._skipBefore = None
+
+		# unit -> ServicePipeline, pipelines set by a reload wait in _pending
+		# until the thread picks them up
+		self._routes = self.__buildRoutes(pipelines)
+		self._pending = None
+		self._lock = threading.Lock()
+		self._closed = False
 
 		self.j = journal.Reader()
-		self.j.log_level(journal.LOG_INFO)
-		try:
-			self.j.add_match(_SYSTEMD_UNIT="{}.service".format(rule_list[0].getNameOfBelongService()))
-		except:
-			return
-		if self.retroactive == False:
-			self.j.seek_tail()
-		self.j.get_previous()
+		threshold = self._prefs.getGeneralPref('JOURNALD_DATA_THRESHOLD', None)
+		if threshold != None:
+			# larger fields are truncated when read
+			self.j.data_threshold = int(threshold)
+		self._fields = self.__journalFields()
+		self.__addMatches()
+		self.seekCheckpoint()
+		# opened last, nothing can fail after it and leak the fds
+		self._wakeup, self._notify = os.pipe()
 		pass
 
-	def run(self):
-		#rule = None
-		if self.rules == [] or self.rules == None:
-			return
+	def __buildRoutes(self, pipelines):
+		return dict(("{}.service".format(pipeline.name), pipeline) for pipeline in pipelines)
 
-		#for rule in self.rules:
-			#print(rule)
-			#break
-			#print("Journald_watcher.run -> {}".format(rule.getRulename()))
+	# flush_matches() drops the PRIORITY matches of log_level() too
+	def __addMatches(self):
+		self.j.log_level(journal.LOG_INFO)
+		for unit in self._routes:
+			self.j.add_match(_SYSTEMD_UNIT=unit)
+
+	# Moves the reader right after the last processed entry
+	def seekCheckpoint(self):
+		checkpoint = self.store.get(JOURNALD_CHECKPOINT)
+		if checkpoint is not None:
+			identity, cursor = checkpoint
+			try:
+				self.j.seek_cursor(cursor)
+				# the entry of the cursor was processed already
+				self.j.get_next()
+				if not self.j.test_cursor(cursor):
+					# it was vacuumed meanwhile (or is not matched any more),
+					# the entry we are at was not processed yet
+					self.j.get_previous()
+				self._cursor = cursor
+				print("Journald watcher resumes after cursor [{}]".format(cursor))
+				return
+			except Exception as e:
+				print("ERROR: Journal cursor could not be restored ~ {}".format(e))
+
+		retroactive = [pipeline for pipeline in self._routes.values() if pipeline.retroactive == True]
+		if retroactive != []:
+			self.j.seek_head()
+			if len(retroactive) < len(self._routes):
+				self._skipBefore = time.time()
+		else:
+			self.j.seek_tail()
+			last = self.j.get_previous()
+			# the entries logged from now on are not lost if the daemon stops before reading them
+			if last:
+				self._cursor = last.get('__CURSOR')
+				self.saveCheckpoint()
+
+	def saveCheckpoint(self):
+		if self._cursor is not None:
+			self.store.update(JOURNALD_CHECKPOINT, KIND_JOURNALD, "shared", self._cursor)
+
+	# New pipelines after a reload of the config, picked up by the thread as soon as possible
+	def setPipelines(self, pipelines):
+		with self._lock:
+			if self._closed:
+				# the next tick starts a new reader with the new pipelines
+				return
+			self._pending = pipelines
+			os.write(self._notify, b"\0")
+
+	def __applyPending(self):
+		with self._lock:
+			pipelines = self._pending
+			self._pending = None
+		if pipelines is None:
+			return
+		routes = self.__buildRoutes(pipelines)
+		if routes == {} or set(routes) == set(self._routes):
+			# without any unit the old matches stay, their entries find no route
+			self._routes = routes
+			self._fields = self.__journalFields()
+			return
+		# other units, same position
+		self.saveCheckpoint()
+		self.j.flush_matches()
+		self._routes = routes
+		self._fields = self.__journalFields()
+		self.__addMatches()
+		self.seekCheckpoint()
 
-		#print("Processing {}".format(rule.getNameOfBelongService()))
+	def run(self):
+		try:
+			self.watch()
+		finally:
+			# a watcher that died is replaced by a new one at the next tick
+			self.close()
 
+	def watch(self):
 		p = select.poll()
 		p.register(self.j, self.j.get_events())
+		p.register(self._wakeup, select.POLLIN)
 
-		if self.retroactive == True:
-			# Send a message to journald to generate a I/O traffic
-			# so that poll catches events in the past without having
-			# to wait for journal.APPEND to occur naturally.
-			journal.send("GGH")
+		# the entries logged since the checkpoint (all of them if RETROACTIVE)
+		# are there already, they do not wait for the next journal.APPEND
+		self.drain()
 
 		# Inspiration taken from https://yalis.fr/git/yves/pyruse/src/branch/master/pyruse/main.py
 		# In accordance with § 31 odst. 1 písm. a) zákona č. 121/2000 Sb., autorský zákon
-		while p.poll():
+		while True:
+			events = dict(p.poll())
+			if self._wakeup in events:
+				os.read(self._wakeup, 512)
+				self.__applyPending()
 			#print(self.j.process())
-			if self.j.process() != journal.APPEND:
-				continue
-			for entry in self.j:
-				if entry['MESSAGE'] != "":
-					# Print SYSTEMD messages for debugging
-					#print(str(entry['__REALTIME_TIMESTAMP'])+ ' ' + entry['MESSAGE'])
-					#print()
-					for rule in self.rules:
-						self.processRule(rule, entry['MESSAGE'])
-		pass
+			if self.j.process() != journal.NOP or self._wakeup in events:
+				self.drain()
+
+	# Releases the journal, the wakeup pipe and the database connection
+	def close(self):
+		with self._lock:
+			if self._closed:
+				return
+			self._closed = True
+			os.close(self._wakeup)
+			os.close(self._notify)
+		self.j.close()
+		self.db.close()
+
+	# Processes every entry not read yet, in batches of JOURNALD_BATCH_SIZE entries
+	def drain(self):
+		routes = self._routes
+		processed = 0
+		deadline = time.time() + self._checkpointInterval
+		entry = self.nextEntry()
+		while entry:
+			pipeline = routes.get(journalText(entry.get('_SYSTEMD_UNIT')))
+			if pipeline is not None and not self.isSkipped(pipeline, entry):
+				self.processEntry(pipeline, entry)
+			self._cursor = entry.get('__CURSOR', self._cursor)
+			processed += 1
+			if processed % self._batchSize == 0 or time.time() >= deadline:
+				submitBatches(self.batches)
+				self.saveCheckpoint()
+				deadline = time.time() + self._checkpointInterval
+			entry = self.nextEntry()
+		submitBatches(self.batches)
+		self.saveCheckpoint()
+
+	# Next entry with only the fields the rules look at. They are read one by one
+	# (sd_journal_get_data) instead of all the fields of the entry being enumerated
+	# and converted. A reader without this part of the python-systemd API gets whole entries.
+	def nextEntry(self):
+		if self._fields is None:
+			return self.j.get_next()
+		if not self.j._next(1):
+			return {}
+		entry = {'__CURSOR': self.j._get_cursor()}
+		if self._skipBefore is not None:
+			entry['__REALTIME_TIMESTAMP'] = self.j._convert_field('__REALTIME_TIMESTAMP', self.j._get_realtime())
+		for field in self._fields:
+			try:
+				entry[field] = self.j._convert_field(field, self.j._get(field))
+			except (KeyError, OSError):
+				# the entry does not have it
+				pass
+		return entry
+
+	def __journalFields(self):
+		# nextEntry() uses these private methods of systemd.journal.Reader, all of them
+		# are checked before the first entry is read so that the reading never switches
+		# to get_next() in the middle of an entry
+		if not all(hasattr(self.j, method) for method in JOURNAL_PRIVATE_API):
+			return None
+		fields = set()
+		for pipeline in self._routes.values():
+			fields |= pipeline.journalFields
+		return fields
+
+	def processEntry(self, pipeline, entry):
+		fields = dict((field, journalText(value)) for field, value in entry.items() if field in pipeline.journalFields)
+		if pipeline.prefilterMessage:
+			message = fields.get(DEFAULT_REGEX_FIELD)
+			# Print SYSTEMD messages for debugging
+			#print(str(entry['__REALTIME_TIMESTAMP'])+ ' ' + message)
+			if not message or not pipeline.prefilter.check(message):
+				return
+		for rule in pipeline.rules:
+			self.processRule(rule, fields, pipeline.prefilter)
+
+	# Entries logged before the start are read from the head for the RETROACTIVE services only
+	def isSkipped(self, pipeline, entry):
+		if self._skipBefore is None or pipeline.retroactive == True:
+			return False
+		timestamp = entry.get('__REALTIME_TIMESTAMP')
+		if timestamp is None:
+			return False
+		if timestamp.timestamp() >= self._skipBefore:
+			# everything after is new
+			self._skipBefore = None
+			return False
+		return True
 
-	def processRule(self, rule, message):
+	# fields holds the text of the fields of the entry the rules of the service look at
+	def processRule(self, rule, fields, prefilter):
 		#print("{} - Processing the message for the rule {} ...".format(self.name, rule.getRulename()))
-		regexyolo = re.compile(rule.getRegex())
+		if not rule.matchesFields(fields):
+			return
+		message = fields.get(rule.getRegexField())
+		if not message or not prefilter.ruleMayMatch(rule, message):
+			return
+		regexyolo = rule.getCompiledRegex()
+		if regexyolo is None:
+			return
 		r1 = regexyolo.search(message)
 		if r1 is not None:
 			print("Rule {} -> {} triggered".format(rule.getNameOfBelongService(), rule.getRulename()))
 			try:
-				ipaddr = r1.group(rule.getCriteriaToDistinguish())
-				if checkIPenabled(ipaddr) == 1:
+				criteriaField = rule.getCriteriaField()
+				if criteriaField is not None:
+					# the distingueur is a field of the entry
+					ipaddr = fields[criteriaField]
+				else:
+					ipaddr = r1.group(rule.getCriteriaGroupIndex())
+				verdict = checkIPenabled(ipaddr)
+				if verdict == 1:
 					return
-				dictx = rule.getIpXoccurDict()
-				ipcnt = dictx.get(ipaddr, 0) # 0 is the default value if key does not exist
-				#print("ipaddr {} / {}".format(ipaddr, ipcnt))
-				rule.updateIpXoccur(ipaddr, ipcnt + 1)
+				cnt = rule.hitDistingueur(ipaddr)
 
 			except:
-				pass
+				return
+
+			# Sanction maybe? Only the counter bumped by this message is checked
+			if verdict == 0 or cnt >= rule.getEffectiveThresholdCount():
+				self.sanctionner(rule, ipaddr)
+
+	def sanctionner(self, rule, element):
+		sanction(rule, element, self.db, self.batches)
+		print("{} : {} distingueurs counted".format(rule.getRulename(), len(rule.getCounter())))
+
+# Text of a journald field as converted by python-systemd: int, UUID, datetime,
+# bytes which are not valid UTF-8 or a list if the entry has the field several times
+def journalText(value):
+	if isinstance(value, list):
+		value = value[0] if value != [] else None
+	if value is None:
+		return None
+	if isinstance(value, bytes):
+		return value.decode(errors="replace")
+	return str(value)
+
+# Replace CRITERIA_TO_DISTINGUISH group placeholder in an ACTION/ANTIACTION template
+def substituteDistingueur(rule, template, element):
+	if template == None:
+		return None
+	return re.sub(rule.getCriteriaToDistinguish(), str(element), template)
+
+# Imposes the sanction of the rule on element: ACTION (or its batch), the events
+# entry with the ANTIACTION and the eventlog entry, then resets its counter
+def sanction(rule, element, db, batches):
+	_prefs = Prefs()
 
-			# Sanction maybe?
-			self.sanctionner(rule)
-
-	def sanctionner(self, rule):
-		threshold_count = rule.getThresholdCount() if rule.getThresholdCount() != None else self._prefs.getGeneralPref('THRESHOLDCOUNT')
-		tempAction = rule.getAction()
-		tempAntiaction = rule.getAntiaction()
-		for element, cnt in rule.getIpXoccurDict().items():
-			if checkIPenabled(element) == 0 or cnt >= int(threshold_count):
-				#print("Threshold count -> {}".format(threshold_count))
-				#print("OccurenceCount after this read -> {}".format(cnt))
-
-				# Replace CRITERIA_TO_DISTINGUISH group placeholder in Regex
-				if tempAction != None:
-					replaced1 = re.sub(rule.getCriteriaToDistinguish(), str(element), tempAction)
-					rule.setAction(replaced1)
-
-					# check if such a tuple (rule,distingueur) is already in database
-					# if it is, we do not want to apply ACTION and ANTIACTION again
-					# nor we want to log this event to events table, only eventlog
-					if self._prefs.getGeneralPref('DO_NOT_DUPLICATE').lower() == 'true':
-						if self.db.checkDistingueurDetectedForRule(element, rule.getRulename()) == False:
-							# Run the action, let it roll baby
-							print("FIRST TIME")
-							print("Executing ACTION -> {}".format(rule.getAction()))
-							Utils.execute_action(rule.getAction())
-						else:
-							print("DO_NOT_DUPLICATE is ON -> skipping ACTION")
-					else:
-						# Run the action, let it roll baby
-						print("Executing ACTION -> {}".format(rule.getAction()))
-						Utils.execute_action(rule.getAction())
-
-				if tempAntiaction != None:
-					replaced2 = re.sub(rule.getCriteriaToDistinguish(), str(element), tempAntiaction)
-					rule.setAntiaction(replaced2)
-
-				#print(rule.getAntiaction())
-
-				# Add event to DB
-				# Here is important if Antiaction is set. If that is the case, the event is added both to events and eventlog tables
-				# In events table are stored only events with antiaction
-				if self._prefs.getGeneralPref('DO_NOT_DUPLICATE').lower() == 'true':
-					if self.db.checkDistingueurDetectedForRule(element, rule.getRulename()) == False:
-						print("FIRST TIME")
-						# Add event to DB events table
-						if rule.getAntiaction() != None:
-							self.db.addEvent(rule.getNameOfBelongService(), rule.getRulename(), element, time.asctime(), 
-								rule.getJailtime() if rule.getJailtime() != None else self._prefs.getGeneralPref('JAILTIME'), rule.getAntiaction())
-					else:
-						print("DO_NOT_DUPLICATE is ON -> skipping DB store to events.")
-
-				# Add event to DB eventlog table
-				self.db.addEventlog(rule.getNameOfBelongService(), rule.getRulename(), element, time.asctime())
-
-				# We imposed the sanction, now we reset the counter
-				# Die Strafe wird getilgt, nehehe
-				rule.updateIpXoccur(element, 0)
-
-		print("{} : OCCURCNT DICT -> {}".format(rule.getRulename(), rule.getIpXoccurDict()))
+	# check if such a tuple (rule,distingueur) is already in database
+	# if it is, we do not want to apply ACTION and ANTIACTION again
+	# nor we want to log this event to events table, only eventlog
+	doNotDuplicate = _prefs.getGeneralPref('DO_NOT_DUPLICATE').lower() == 'true'
+	alreadyDetected = doNotDuplicate and db.checkDistingueurDetectedForRule(element, rule.getRulename())
+
+	if rule.getAction() != None or rule.getBatchAction() != None:
+		if alreadyDetected:
+			print("DO_NOT_DUPLICATE is ON -> skipping ACTION")
+		else:
+			# Run the action, let it roll baby
+			dispatchAction(rule, element, batches)
+
+	# Add event to DB
+	# Here is important if Antiaction is set. If that is the case, the event is added both to events and eventlog tables
+	# In events table are stored only events with antiaction
+	if doNotDuplicate:
+		if alreadyDetected:
+			print("DO_NOT_DUPLICATE is ON -> skipping DB store to events.")
+		elif rule.getAntiaction() != None or rule.getBatchAntiaction() != None:
+			db.addEvent(rule.getNameOfBelongService(), rule.getRulename(), element, time.asctime(),
+				rule.getJailtime() if rule.getJailtime() != None else _prefs.getGeneralPref('JAILTIME'),
+				substituteDistingueur(rule, rule.getAntiaction(), element))
+
+	# Add event to DB eventlog table
+	db.addEventlog(rule.getNameOfBelongService(), rule.getRulename(), element, time.asctime())
+
+	# We imposed the sanction, now we reset the counter
+	# Die Strafe wird getilgt, nehehe
+	rule.resetDistingueur(element)
+
+# Runs the ACTION of the rule for element, or collects element for the
+# BATCH_ACTION of the rule
+def dispatchAction(rule, element, batches):
+	if rule.getBatchAction() != None:
+		batches.setdefault(rule, []).append(element)
+	else:
+		action = substituteDistingueur(rule, rule.getAction(), element)
+		print("Executing ACTION -> {}".format(action))
+		ActionExecutor.getInstance().submit(action, target=element)
+
+# One BATCH_ACTION command per rule for all the collected distingueurs
+def submitBatches(batches):
+	for rule, elements in batches.items():
+		ActionExecutor.getInstance().submitBatch(rule.getBatchAction(), rule.getBatchActionLine(),
+			rule.getCriteriaToDistinguish(), elements)
+	batches.clear()
 
 # returns 0 if denied
 # returns 1 if allowed
 # returns 2 if ip is not within the scope of any apriori rule
 def checkIPenabled(ip):
-	_prefs = Prefs()
-	_deny = _prefs.getGeneralPref('HOSTS_DENY').split(",")
-	_allow = _prefs.getGeneralPref('HOSTS_ALLOW').split(",")
-
-	# HOSTS_ALLOW is privileged to HOSTS_DENY
-	for net in _allow:
-		if ipaddress.ip_address(ip) in ipaddress.ip_network(net):
-			#print("IP apriori allowed -> {}".format(ip))
-			return 1
-
-	for net in _deny:
-		if ipaddress.ip_address(ip) in ipaddress.ip_network(net):
-			#print("IP apriori denied -> {}".format(ip))
-			return 0
-
-	return 2
+	# HOSTS_ALLOW is privileged to HOSTS_DENY, the index is built once from the config
+	# and keeps an LRU of recent verdicts
+	return Prefs().getHostsIndex().check(ip)
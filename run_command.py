@@ -1,3 +1,4 @@
+import errno
 import fcntl
 import logging
 import os
@@ -20,6 +21,10 @@ logSys = logging.getLogger(__name__)
 
 PREFER_ENC = locale.getpreferredencoding()
 
+# Signal numbers to names, used when a command was killed
+signame = dict((num, name)
+	for name, num in signal.__dict__.items() if name.startswith("SIG") and not name.startswith("SIG_"))
+
 def uni_decode(x, enc=PREFER_ENC, errors='strict'):
 	try:
 		if isinstance(x, bytes):
@@ -44,11 +49,10 @@ class Utils(object):
 	DEFAULT_SHORTEST_INTERVAL = DEFAULT_SHORT_INTERVAL / 100
 
 	@staticmethod
-	def execute_action(action):
+	def execute_action(action, timeout=60):
 		if action.startswith('"') and action.endswith('"'):
 			action = (str(action)[1:-1])
-		Utils.executeCmd(action)
-		pass
+		return Utils.executeCmd(action, timeout=timeout)
 
 	@staticmethod
 	def buildShellCmd(realCmd, varsDict):
@@ -205,6 +209,28 @@ class Utils(object):
 			return success, stdout, stderr, retcode
 		return success if len(success_codes) == 1 else (success, retcode)
 	
+	@staticmethod
+	def setFBlockMode(fhandle, value):
+		flags = fcntl.fcntl(fhandle, fcntl.F_GETFL)
+		if not value:
+			flags |= os.O_NONBLOCK
+		else:
+			flags &= ~os.O_NONBLOCK
+		fcntl.fcntl(fhandle, fcntl.F_SETFL, flags)
+		return flags
+
+	@staticmethod
+	def pid_exists(pid):
+		"""Check whether pid exists in the current process table."""
+		if pid < 0:
+			return False
+		try:
+			os.kill(pid, 0)
+		except OSError as e:
+			return e.errno == errno.EPERM
+		else:
+			return True
+
 	@staticmethod
 	def wait_for(cond, timeout, interval=None):
 		"""Wait until condition expression `cond` is True, up to `timeout` sec
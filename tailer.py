@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from threading import Thread
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Watched on the log file itself and on its directory (the file coming back after a rotation)
+FILE_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+DIR_MASK = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+EVENT_BUFFER = 65536
+
+
+# Resolves LOG_LOCATION, relative paths are relative to GGH directory
+def resolveLogfile(logfile):
+	if logfile.startswith('/'):
+		return logfile
+	return os.path.dirname(os.path.realpath(__file__)) + '/' + logfile
+
+
+# Thin ctypes binding of inotify, raises OSError if the kernel or libc does not have it
+class Inotify(object):
+	def __init__(self):
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or "libc.so.6", use_errno=True)
+		try:
+			self._add = libc.inotify_add_watch
+			self._rm = libc.inotify_rm_watch
+			init = libc.inotify_init1
+		except AttributeError:
+			raise OSError(errno.ENOSYS, "inotify is not available")
+		self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		self._rm.argtypes = [ctypes.c_int, ctypes.c_int]
+
+		self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			err = ctypes.get_errno()
+			raise OSError(err, os.strerror(err))
+
+	def fileno(self):
+		return self.fd
+
+	# returns the watch descriptor, -1 if path cannot be watched (e.g. it does not exist yet)
+	def addWatch(self, path, mask):
+		return self._add(self.fd, os.fsencode(path), mask)
+
+	def rmWatch(self, wd):
+		self._rm(self.fd, wd)
+
+	# (wd, mask, name) of all the queued events
+	def readEvents(self):
+		events = []
+		while True:
+			try:
+				buf = os.read(self.fd, EVENT_BUFFER)
+			except BlockingIOError:
+				return events
+			pos = 0
+			while pos + EVENT_HEADER.size <= len(buf):
+				wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+				pos += EVENT_HEADER.size
+				name = buf[pos:pos + length].rstrip(b'\0')
+				pos += length
+				events.append((wd, mask, os.fsdecode(name)))
+
+
+# Wakes up the scanning of a log file as soon as something is written to it.
+# Every watched file has an inotify watch (modification, rotation) and its directory
+# another one (the file created again after a rotation). Without inotify, or when
+# LOG_WATCHER = poll, the files are stat()ed every pollInterval seconds instead.
+class LogTailer(Thread):
+	def __init__(self, pollInterval = 30, useInotify = True):
+		super(LogTailer, self).__init__()
+		self.name = "Log tailer"
+		self.daemon = True
+		self._pollInterval = pollInterval
+		self._lock = threading.Lock()
+		# path -> callback
+		self._callbacks = {}
+		# path -> (st_ino, st_size, st_mtime_ns) at the last poll
+		self._stats = {}
+		# watch descriptor -> path, directory -> watched paths in it
+		self._fileWatches = {}
+		self._dirWatches = {}
+		self._dirs = {}
+		self._pending = set()
+
+		self._inotify = None
+		if useInotify:
+			try:
+				self._inotify = Inotify()
+			except OSError as e:
+				print("inotify not available, polling log files every {}s ~ {}".format(pollInterval, e))
+
+	def isUsingInotify(self):
+		return self._inotify is not None
+
+	# Calls callback() whenever path changes, and once right away to catch up.
+	# Watching a path again only replaces its callback.
+	def watch(self, path, callback):
+		with self._lock:
+			known = path in self._callbacks
+			self._callbacks[path] = callback
+			if known:
+				return
+			if self._inotify is not None:
+				self.__addFileWatch(path)
+				directory = os.path.dirname(path)
+				if directory not in self._dirWatches.values():
+					wd = self._inotify.addWatch(directory, DIR_MASK)
+					if wd >= 0:
+						self._dirWatches[wd] = directory
+				self._dirs.setdefault(directory, set()).add(path)
+			self._pending.add(path)
+
+	# Stops watching path
+	def unwatch(self, path):
+		with self._lock:
+			self._callbacks.pop(path, None)
+			self._stats.pop(path, None)
+			self._pending.discard(path)
+			for wd, watched in list(self._fileWatches.items()):
+				if watched == path:
+					del self._fileWatches[wd]
+					self._inotify.rmWatch(wd)
+			self._dirs.get(os.path.dirname(path), set()).discard(path)
+
+	def __addFileWatch(self, path):
+		wd = self._inotify.addWatch(path, FILE_MASK)
+		if wd >= 0:
+			self._fileWatches[wd] = path
+
+	def run(self):
+		while True:
+			with self._lock:
+				changed = self._pending
+				self._pending = set()
+			if changed == set():
+				if self._inotify is not None:
+					ready, _, _ = select.select([self._inotify], [], [], self._pollInterval)
+					changed = self.__readEvents() if ready else self.__pollChanged()
+				else:
+					time.sleep(self._pollInterval)
+					changed = self.__pollChanged()
+
+			for path in changed:
+				self.__dispatch(path)
+
+	# Paths touched by the queued inotify events, the watch of a file
+	# is added again when the file is back after a rotation
+	def __readEvents(self):
+		changed = set()
+		with self._lock:
+			for wd, mask, name in self._inotify.readEvents():
+				if wd in self._fileWatches:
+					path = self._fileWatches[wd]
+					if mask & (IN_MOVE_SELF | IN_DELETE_SELF | IN_IGNORED):
+						# rotated away, the new file shows up in the directory
+						del self._fileWatches[wd]
+						if not mask & IN_IGNORED:
+							self._inotify.rmWatch(wd)
+					changed.add(path)
+				elif wd in self._dirWatches:
+					path = os.path.join(self._dirWatches[wd], name)
+					if path in self._dirs.get(self._dirWatches[wd], ()):
+						if path not in self._fileWatches.values():
+							self.__addFileWatch(path)
+						changed.add(path)
+		return changed
+
+	# Paths whose inode, size or mtime changed since the previous poll
+	def __pollChanged(self):
+		changed = set()
+		with self._lock:
+			paths = list(self._callbacks)
+		for path in paths:
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+			if self._stats.get(path) != stat:
+				self._stats[path] = stat
+				changed.add(path)
+			if self._inotify is not None and path not in self._fileWatches.values():
+				# created after watch() was called
+				with self._lock:
+					self.__addFileWatch(path)
+		return changed
+
+	def __dispatch(self, path):
+		with self._lock:
+			callback = self._callbacks.get(path)
+		if callback is None:
+			return
+		try:
+			callback()
+		except Exception as e:
+			print("ERROR: Scanning [{}] failed ~ {}".format(path, e))